@@ -1,7 +1,14 @@
-""" Batch script for creating calibration noise WAV files. 
+""" Batch script for creating calibration noise WAV files.
+
+    Usage:
+        python batch_shaper.py [stimulus_dir] [--workers N]
+        python batch_shaper.py [stimulus_dir] --corpus [--ltass FILE]
+        python batch_shaper.py [stimulus_dir] --format flac --compression 8
+        python batch_shaper.py [stimulus_dir] --max-memory 4G
+        python batch_shaper.py [stimulus_dir] --processes 4
 
     Author: Travis M. Moore
-    Last edited: 03/11/2024    
+    Last edited: 03/11/2024
 """
 
 ###########
@@ -11,86 +18,428 @@
 import numpy as np
 # System
 import os
+import argparse
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 # Audio
 import soundfile as sf
 # Custom
+from models import audiomodel
 from models import noisemodel
+from models import fftmodel
+from models import spectrummodel
+from models import writemodel
+from models import plannermodel
+from models import sharedmodel
 
 
 #################
 # Organize Data #
 #################
-# Import WAV file paths
+# Default directory of WAV files
 _path = r'C:\Users\MooTra\OneDrive - Starkey\Desktop\stimuli'
-files = Path(_path).glob('*.wav')
-files = list(files)
 
 
 #############
 # Functions #
 #############
-def multichannel_shaping(audio, fs, correlated, filename):
-    """ Apply noise shaping code to file with any number of channels. """
-    # Get number of channels
-    try:
-        num_channels = audio.shape[1]
-    except IndexError:
-        num_channels = 1
+def multichannel_shaping(audio, fs, correlated, filename, spectrum=None,
+        out=None, processes=None, pool=None, **kwargs):
+    """ Apply noise shaping code to file with any number of channels. 
+        AUDIO is channel-major (C, N), as audiomodel.Audio.data or a 
+        sharedmodel.SharedArray, and may be None if a precomputed 
+        SPECTRUM is given. Channels are 
+        copied into the rows of OUT, a (C, N) array (e.g., a memory-
+        mapped buffer), as they finish; by default one is allocated. 
+        Keyword arguments are passed on to noisemodel.shape_channels().
 
-    # Instantiate NoiseShaper
-    ns = noisemodel.NoiseShaper()
+        With PROCESSES, channels are shaped in worker processes 
+        (sharedmodel.shape_channels(), in POOL if given) that write 
+        straight into OUT, which must then be a 
+        sharedmodel.SharedArray.
+    """
+    # Get number of channels
+    if spectrum is not None:
+        num_channels = spectrum.num_channels
+    else:
+        num_channels = audio.shape[0]
 
     # Apply noise shaper to each channel
-    cal_noises = []
-    for ii in range(0, num_channels):
-        msg = f"Status: Processing channel {ii+1} of {num_channels}"
+    if processes:
+        # A stimulus already in shared memory is not copied again
+        stimulus = None
+        if isinstance(audio, sharedmodel.SharedArray):
+            stimulus, audio = audio, None
+        cal_noise_array = out.array
+        results = sharedmodel.shape_channels(
+            audio=audio,
+            stimulus=stimulus,
+            fs=fs,
+            correlated=correlated,
+            out=out,
+            processes=processes,
+            pool=pool,
+            spectrum=spectrum,
+            channel_major=True,
+            **kwargs
+        )
+    else:
+        cal_noise_array = out
+        results = noisemodel.shape_channels(
+            audio=audio,
+            fs=fs,
+            correlated=correlated,
+            spectrum=spectrum,
+            channel_major=True,
+            **kwargs
+        )
+    for ii, result in results:
+        msg = f"Status: Finished channel {ii+1} of {num_channels}"
         print("")
         print('*' * len(msg))
         print(msg)
         print('*' * len(msg))
         print(f"batch_shaper: Processing {filename}")
-        # Create shaped noise
-        if num_channels > 1:
-            cal_noise = ns.shape_noise(
-                audio=audio[:, ii],
-                fs=fs,
-                correlated=correlated,
-            )
-        elif num_channels == 1:
-            cal_noise = ns.shape_noise(
-                audio=audio,
-                fs=fs,
-                correlated=correlated,
-            )
-
-        cal_noises.append(cal_noise)
-
-    # Convert list into numpy array and transpose
-    cal_noise_array = np.array(cal_noises).T
+        size = result.info.get('num_taps', 
+            result.info.get('order', result.info.get('bins')))
+        print(f"batch_shaper: {result.info['engine'].upper()} of size " +
+            f"{size}, spectral error " + 
+            f"{np.round(result.info['match_error_db'], 2)} dB")
+        if result.noise is None:
+            # Already written to shared memory by the worker
+            continue
+        if cal_noise_array is None:
+            cal_noise_array = np.empty((num_channels, len(result.noise)))
+        cal_noise_array[ii] = result.noise
+        result.noise = None
+
     print(f"\nbatch_shaper: Final array shape: {cal_noise_array.shape}")
 
-    return cal_noise_array
+    # Return the shaping details of the last channel along with the noise
+    return cal_noise_array, result.info
+
+
+def _write_file(filename, data, fs, buffer_path=None, shared=None, 
+        **kwargs):
+    """ Write one calibration file. If BUFFER_PATH is given, the 
+        noise is read from that memory-mapped .npy file, which is 
+        deleted afterwards. If SHARED is given, the noise is read 
+        from that sharedmodel.SharedArray, which is released 
+        afterwards.
+    """
+    try:
+        if buffer_path:
+            data = np.load(buffer_path, mmap_mode='r')
+        elif shared is not None:
+            data = shared.array
+        writemodel.write(filename, data, fs, **kwargs)
+    finally:
+        # Views must be dropped before the buffer is released
+        data = None
+        if buffer_path:
+            os.remove(buffer_path)
+        if shared is not None:
+            shared.close()
+
+
+def _check_write(filename, future):
+    """ Wait for one background write. A failed write is 
+        reported and the batch carries on.
+
+        :returns: 1 if the write failed, otherwise 0
+    """
+    try:
+        future.result()
+    except Exception as e:
+        print(f"\nbatch_shaper: Could not write {filename}: {e}")
+        return 1
+    return 0
+
+
+def corpus_shaping(files, correlated, ltass_path, filename, 
+        subtype='FLOAT', extension='.wav', compression=None, **kwargs):
+    """ Create one calibration noise matching the long-term average 
+        spectrum (LTASS) of a corpus of files. Keyword arguments are 
+        passed on to noisemodel.shape_noise().
+    """
+    # Extend the saved corpus spectrum, if any
+    ltass = None
+    if ltass_path and os.access(ltass_path, os.F_OK):
+        ltass = spectrummodel.LTASS.load(ltass_path)
+
+    # Map-reduce over the corpus
+    ltass = spectrummodel.analyse_corpus(files, ltass=ltass, 
+        processes=fftmodel.config.workers)
+    if ltass_path:
+        ltass.save(ltass_path)
+
+    # One shaping pass driven by the merged spectrum
+    result = noisemodel.shape_noise(
+        audio=None,
+        fs=ltass.fs,
+        correlated=correlated,
+        spectrum=ltass.spectrum(),
+        **kwargs
+    )
+
+    # Write WAV to current directory
+    filename = filename + '_ltass_cal' + extension
+    print(f"\nbatch_shaper: Writing {filename} " +
+        f"({len(ltass.files)} files in corpus)")
+    writemodel.write(filename, result.noise, ltass.fs, metadata=result.info,
+        subtype=subtype, compression=compression)
+
+
+def parse_args():
+    """ Parse command line arguments. """
+    parser = argparse.ArgumentParser(
+        description="Create calibration noise WAV files for a " +
+            "directory of stimuli.")
+    parser.add_argument('path', nargs='?', default=_path,
+        help="Directory containing the stimulus .wav files")
+    parser.add_argument('--workers', type=int, default=None,
+        help="Total number of threads (default: CPU count)")
+    parser.add_argument('--preset', default=None,
+        help="'preview', 'standard', 'reference' or 'budget:X' " +
+            "(X seconds per file). Sets the filter, resolution " +
+            "and duration options; options given explicitly (e.g. " +
+            "--loopable, --order, --duration) take precedence.")
+    parser.add_argument('--engine', choices=('fir', 'iir', 'spectral'), 
+        default=None,
+        help="Shaping filter: linear-phase FIR, low-order IIR or " +
+            "frequency-domain synthesis (default: fir)")
+    parser.add_argument('--order', type=int, default=None,
+        help="IIR model order (default: 24, or the lowest order " +
+            "meeting --tolerance)")
+    parser.add_argument('--tolerance', type=float, default=None,
+        help="Spectral-match tolerance (dB) for choosing the " +
+            "shortest filter (default: fixed filter length)")
+    parser.add_argument('--smoothing', type=int, default=None,
+        help="Smooth the stimulus PSD to 1/N octave before " +
+            "filter design")
+    parser.add_argument('--duration', default=None,
+        help="Calibration noise duration: seconds, 'match' " +
+            "(stimulus length) or 'psd:X' (shortest noise with a " +
+            "PSD standard deviation of X dB; default: 30)")
+    parser.add_argument('--loopable', action='store_true',
+        help="Filter circularly so the output loops without " +
+            "clicks (no trimming or gating)")
+    parser.add_argument('--psd-tolerance', type=float, default=None,
+        help="Estimate the stimulus PSD from randomly sampled " +
+            "segments until every bin is within this many dB " +
+            "(95%% confidence), instead of reading the whole file")
+    parser.add_argument('--subtype', choices=writemodel.SUBTYPES, 
+        default='match',
+        help="Output sample format; PCM is TPDF-dithered " +
+            "(default: match the stimulus, or FLOAT in corpus mode)")
+    parser.add_argument('--format', choices=('wav', 'flac', 'w64', 'rf64'),
+        default='wav',
+        help="Output file format: WAV, FLAC (lossless compressed), " +
+            "or Wave64/RF64 for files over 4 GB (default: wav)")
+    parser.add_argument('--compression', type=int, default=5,
+        choices=range(9), metavar='{0-8}',
+        help="FLAC compression level, 0 (fastest) to 8 (smallest); " +
+            "does not change the samples (default: 5)")
+    parser.add_argument('--processes', type=int, default=None,
+        help="Shape channels in N worker processes instead of " +
+            "threads. The stimulus and output are shared with the " +
+            "workers through shared memory, not copied (default: " +
+            "threads)")
+    parser.add_argument('--writers', type=int, 
+        default=min(4, os.cpu_count() or 1),
+        help="Number of files encoded and written concurrently " +
+            "while the next files are shaped (default: up to 4)")
+    parser.add_argument('--max-memory', default=None,
+        help="Memory budget for audio data per file, e.g. 512M or " +
+            "4G (the interpreter itself is not counted). Chooses how " +
+            "many channels run at once, block sizes and streamed or " +
+            "on-disk paths so the job fits; files that cannot fit " +
+            "are skipped")
+    parser.add_argument('--corpus', action='store_true',
+        help="Create one calibration noise matching the long-term " +
+            "average spectrum of all files")
+    parser.add_argument('--ltass', default=None,
+        help="Corpus mode: .npz file holding the running corpus " +
+            "spectrum. Only files added since the last run are analysed.")
+    parser.add_argument('--noise-cache', default=None,
+        help="Directory for memory-mapped correlated noise " +
+            "realizations, shared between runs")
+    return parser.parse_args()
 
 
 ##############
 # Controller #
 ##############
-# Create calibration noises
-for file in files:
-    # Read in audio
-    sig, fs = sf.read(file)
-
-    # Create calibration noise for each channel
-    cal_noise = multichannel_shaping(
-        audio=sig, 
-        fs=fs, 
-        correlated=True,
-        filename=os.path.basename(file)
-    )
-    
-    # Get filename minus extension and append "_cal"
-    filename = os.path.basename(file)[:-4] + '_cal.wav'
+def main():
+    args = parse_args()
 
-    # Write WAV to current directory
-    sf.write(filename, cal_noise, fs)
+    # Apply performance settings
+    fftmodel.configure(workers=args.workers)
+    noisemodel.set_noise_cache(args.noise_cache)
+    if args.max_memory:
+        # The plan counts one correlated noise realization (per 
+        # process); older ones are dropped before a new one is made
+        noisemodel.noise_provider.max_items = 1
+
+    # Import WAV file paths
+    files = list(Path(args.path).glob('*.wav'))
+
+    # Shaping options given on the command line (unset options 
+    # keep the shape_noise() defaults or the preset's values)
+    user_options = {
+        'engine': args.engine,
+        'tolerance': args.tolerance,
+        'smoothing': args.smoothing,
+        'order': args.order,
+        'loopable': args.loopable or None,
+        'duration': args.duration
+    }
+    options = {key: value for key, value in user_options.items() 
+        if value is not None}
+
+    if args.corpus:
+        if args.preset:
+            options = noisemodel.preset_options(args.preset, 
+                overrides=user_options)
+        corpus_shaping(files, correlated=True, ltass_path=args.ltass,
+            filename=Path(args.path).name, subtype=args.subtype, 
+            extension='.' + args.format, compression=args.compression,
+            **options)
+        return
+
+    # Encode and write files on a thread pool while shaping continues
+    writer = ThreadPoolExecutor(max_workers=max(1, args.writers))
+    pending = []
+    failed = 0
+
+    # One process pool for every file: workers are started (and 
+    # import numpy and scipy) once, not per file
+    pool = sharedmodel.process_pool(args.processes) \
+        if args.processes else None
+
+    # Create calibration noises
+    for file in files:
+        header = sf.info(file)
+        fs = header.samplerate
+
+        # Preset options depend on the file
+        if args.preset:
+            options = noisemodel.preset_options(args.preset, 
+                fs=header.samplerate, num_samples=header.frames, 
+                num_channels=header.channels, overrides=user_options)
+        nperseg = options.get('nperseg', 2048)
+
+        # Fit the job to the memory budget
+        plan = None
+        if args.max_memory:
+            plan = plannermodel.plan_job(header.frames, header.channels, 
+                fs, dict(options, correlated=True), args.max_memory,
+                processes=args.processes)
+            print(f"\nbatch_shaper: Memory plan for {file.name}:\n" +
+                plan.describe())
+            if not plan.fits:
+                print(f"batch_shaper: {file.name} needs about " +
+                    f"{plannermodel.format_size(plan.peak)}, more than " +
+                    "--max-memory allows; skipping")
+                continue
+
+        sig = None
+        spectrum = None
+        if args.psd_tolerance:
+            # Read only the sampled segments of long stimuli
+            spectrum = spectrummodel.estimate(file, nperseg=nperseg,
+                tolerance=args.psd_tolerance)
+        elif plan and plan.analysis == 'stream':
+            # Analyse from disk one block at a time
+            spectrum = spectrummodel.analyse_blocks(file, nperseg=nperseg,
+                block_segments=plan.block_segments)
+        elif plan:
+            # Analyse in memory, then free the stimulus
+            spectrum = spectrummodel.analyse(audiomodel.Audio(file).data, 
+                fs, nperseg=nperseg, channel_major=True)
+        elif args.processes:
+            # Decode straight into shared memory for the workers
+            sig = sharedmodel.read_shared(file)
+        else:
+            # Read in audio (channel-major)
+            sig = audiomodel.Audio(file).data
+
+        # Get filename minus extension and append "_cal"
+        filename = Path(file).stem + '_cal.' + args.format
+
+        # Planned jobs: channel concurrency, blocked output PSD and 
+        # an optional on-disk output buffer
+        shaping = dict(options)
+        out = None
+        buffer_path = None
+        shared = None
+        processes = args.processes
+        shape = (header.channels, noisemodel.noise_length(header.frames, 
+            fs, options.get('duration', 30), nperseg, 
+            options.get('loopable', False)))
+        if plan:
+            shaping.update(block_segments=plan.psd_segments)
+            if processes:
+                processes = min(processes, plan.threads)
+            else:
+                shaping.update(threads=plan.threads)
+            if plan.output == 'memmap':
+                # Shared memory is RAM; keep the buffer on disk
+                processes = None
+                shaping.update(threads=plan.threads)
+                buffer_path = f".{filename}.buffer.npy"
+                out = np.lib.format.open_memmap(buffer_path, mode='w+', 
+                    shape=shape)
+        if processes:
+            # Workers write straight into the shared output buffer
+            shared = out = sharedmodel.SharedArray(shape)
+
+        # Create calibration noise for each channel
+        cal_noise, info = multichannel_shaping(
+            audio=sig,
+            fs=fs,
+            correlated=True,
+            filename=os.path.basename(file),
+            spectrum=spectrum,
+            out=out,
+            processes=processes,
+            pool=pool,
+            **shaping
+        )
+        if isinstance(sig, sharedmodel.SharedArray):
+            sig.close()
+        sig = None
+        if buffer_path:
+            # The writer reopens the buffer from disk
+            cal_noise.flush()
+            cal_noise = out = None
+        elif shared is not None:
+            # The writer reads and then releases the shared buffer
+            cal_noise = out = None
+
+        # Write file to current directory. Waiting for the oldest 
+        # write bounds the number of noises held in memory.
+        future = writer.submit(_write_file, filename, cal_noise, fs, 
+            buffer_path, shared, metadata=info, subtype=args.subtype, 
+            source_subtype=header.subtype, compression=args.compression,
+            blocksize=plan.write_block if plan else 2**16, 
+            channel_major=True)
+        pending.append((filename, future))
+        cal_noise = None
+        limit = plan.pending_writes(args.writers) if plan else args.writers
+        while len(pending) > limit:
+            failed += _check_write(*pending.pop(0))
+
+    if pool is not None:
+        pool.shutdown()
+
+    # Wait for the remaining writes
+    for filename, future in pending:
+        failed += _check_write(filename, future)
+    writer.shutdown()
+    if failed:
+        print(f"\nbatch_shaper: {failed} file(s) could not be written")
+
+
+if __name__ == "__main__":
+    main()
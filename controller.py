@@ -14,9 +14,6 @@
 # Import system packages
 from pathlib import Path
 
-# Import audio packages
-import soundfile as sf
-
 # Import GUI packages
 import tkinter as tk
 from tkinter import ttk
@@ -25,16 +22,12 @@ from tkinter import filedialog
 
 # Import data science packages
 import numpy as np
-import pandas as pd
-import matplotlib
-matplotlib.use('TkAgg')
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import (
-    FigureCanvasTkAgg, NavigationToolbar2Tk)
 
 # Import system packages
 import os
 import sys
+import time
+import threading
 
 # Import web packages
 import webbrowser
@@ -46,7 +39,11 @@ from menus import mainmenu
 # Models
 from models import audiomodel
 from models import noisemodel
-#from models import writemodel
+from models import fftmodel
+from models import writemodel
+from models import plotmodel
+from models import spectrummodel
+from models import livemodel
 from models import updatermodel
 # Views
 from views import mainview
@@ -81,11 +78,25 @@ class Application(tk.Tk):
         self._settings = {
             'noise_type': tk.BooleanVar(value=False),
             #'noise_type': tk.StringVar(value="uncorrelated"),
+            'workers': tk.IntVar(value=fftmodel.config.workers),
+            'preset': tk.StringVar(value='custom'),
+            'duration': tk.StringVar(value='30'),
+            'loopable': tk.BooleanVar(value=False),
+            'engine': tk.StringVar(value='fir'),
+            'tolerance': tk.DoubleVar(value=0.0),
+            'smoothing': tk.IntVar(value=0),
+            'subtype': tk.StringVar(value='match'),
+            'compression': tk.IntVar(value=5),
             'version': self.VERSION,
             'name': self.NAME,
             'last_edited': self.EDITED
         }
 
+        # Thread budget setting drives the global FFT configuration
+        self._settings['workers'].trace_add('write', 
+            lambda *_: fftmodel.configure(
+                workers=self._settings['workers'].get()))
+
         # Create variable dictionary
         self._vars = {
             'in_file': tk.StringVar(value='Name:'),
@@ -96,22 +107,43 @@ class Application(tk.Tk):
             'out_file': tk.StringVar(value='Name:'),
             'out_datatype': tk.StringVar(value='Data Type:'),
             'out_samplingrate': tk.StringVar(value='Sampling Rate:'),
-            'out_channels': tk.StringVar(value='Channels:')
+            'out_channels': tk.StringVar(value='Channels:'),
+
+            'plot_channel': tk.StringVar(value='')
         }
 
+        # Calibration noise, channel-major (C, N)
+        self.cal_noise = None
+
         # Create dicts to hold info for each channel of the 
         # input audio file
-        self.filtered_noises = {}
         self.noise_pwelch = {}
         self.stim_pwelch = {}
+        # Log-frequency binned spectra for plotting
+        self.plot_cache = plotmodel.PlotCache(fraction=24)
+
+        # Shaping options of the last run (written as file metadata)
+        self.shaping_info = {}
+
+        # Background import state
+        self._load_thread = None
+        self._load_error = None
+
+        # Background export state
+        self._export_thread = None
+
+        # Real-time noise generator
+        self._live = None
+
+        # Background render state
+        self._render_thread = None
+        self._render_done = False
+        self._preview_results = None
 
         # Load menus
         menu = mainmenu.MainMenu(self, self._settings)
         self.config(menu=menu)
 
-        # Load noisemodel
-        self.n = noisemodel.NoiseShaper()
-
         # Load writemodel
         #self.w = writemodel.WriteModel()
 
@@ -125,6 +157,13 @@ class Application(tk.Tk):
             row=10, column=5, padx=10, pady=(0,10), sticky='w'
         )
 
+        # Progress bar for background tasks
+        self.progress_var = tk.DoubleVar(value=0)
+        self.progress_bar = ttk.Progressbar(self, length=150, 
+            mode='determinate', maximum=100, variable=self.progress_var)
+        self.progress_bar.grid(row=10, column=5, padx=10, pady=(0,10),
+            sticky='e')
+
         # Create callback dictionary
         event_callbacks = {
             # File menu
@@ -134,6 +173,7 @@ class Application(tk.Tk):
 
             # Tools menu
             '<<ToolsShapeNoise>>': lambda _: self._shape_noise(),
+            '<<ToolsLiveNoise>>': lambda _: self._live_noise(),
 
             # Help menu
             '<<HelpHelp>>': lambda _: self._help(),
@@ -173,6 +213,14 @@ class Application(tk.Tk):
     
     def _quit(self):
         """ Exit the application. """
+        if self._live is not None:
+            self._live.stop()
+        # Let a pending export finish (it is renamed into place 
+        # only when complete)
+        if self._export_thread and self._export_thread.is_alive():
+            self.status_var.set("Status: Finishing export...")
+            self.update_idletasks()
+            self._export_thread.join()
         self.destroy()
 
 
@@ -191,29 +239,85 @@ class Application(tk.Tk):
     # File Menu Functions #
     #######################
     def _import(self):
-        """ Import audio file using audiomodel. Update _vars
-            dict variables with audio data. 
+        """ Import audio file using audiomodel. The header is read 
+            first to fill the _vars dict variables immediately; the 
+            samples are loaded on a background thread.
         """
         self._full_path = Path(filedialog.askopenfilename())
 
         try:
-            self.a = audiomodel.Audio(self._full_path)
-            self._vars["in_file"].set(f"Name: {self.a.name}")
-            self._vars["in_datatype"].set(f"Data Type: {self.a.data_type}")
-            self._vars["in_samplingrate"].set(f"Sampling Rate: {self.a.fs} Hz")
-            self._vars["in_channels"].set(f"Channels: {len(self.a.channels)}")
+            audio = audiomodel.Audio(self._full_path, load=False)
         except FileNotFoundError:
             return
 
+        self.a = audio
+        self._vars["in_file"].set(f"Name: {self.a.name}")
+        self._vars["in_datatype"].set(f"Data Type: {self.a.data_type}")
+        self._vars["in_samplingrate"].set(f"Sampling Rate: {self.a.fs} Hz")
+        self._vars["in_channels"].set(f"Channels: {len(self.a.channels)}")
+        self.main_view.set_channels(len(self.a.channels))
+
+        # Load samples in the background
+        self._load_error = None
+        self._load_thread = threading.Thread(
+            target=self._load_audio, 
+            args=(audio,),
+            daemon=True
+        )
+        self._load_thread.start()
+        self._check_load(audio)
+
+
+    def _load_audio(self, audio):
+        """ Worker thread: read the samples. Does not touch Tk. """
+        try:
+            audio.load()
+        except Exception as e:
+            if audio is getattr(self, 'a', None):
+                self._load_error = e
+
+
+    def _check_load(self, audio):
+        """ Poll the background import and update the progress 
+            bar. Ignores loads superseded by a newer import.
+        """
+        if audio is not getattr(self, 'a', None):
+            return
+
+        if self._load_thread.is_alive():
+            self.status_var.set(f"Status: Loading {audio.name} " +
+                f"({int(audio.progress*100)}%)")
+            self.progress_var.set(audio.progress * 100)
+            self.after(100, self._check_load, audio)
+            return
+
+        self.progress_var.set(0)
+        self.status_var.set("Status: Ready")
+        if self._load_error:
+            messagebox.showerror(
+                title="Import Failed",
+                message=f"Could not read {audio.name}!",
+                detail=str(self._load_error)
+            )
+            del self.a
+
 
     def _export(self):
         """ Write created calibration file to disk. """
-        # Convert filtered noise(s) df
-        df = pd.DataFrame(self.filtered_noises)
+        # Only export full-quality renders
+        if self._render_thread and not self._render_done:
+            messagebox.showwarning(
+                title="Rendering",
+                message="The calibration file is not ready yet!",
+                detail="Please wait for the full-quality render to finish."
+            )
+            return
 
         # Create output file name based on input file name
         try:
             filename = self.a.name[:-4] + '_cal.wav'
+            if self.cal_noise is None:
+                raise AttributeError
         except AttributeError:
             messagebox.showerror(
                 title="File Not Found",
@@ -222,24 +326,97 @@ class Application(tk.Tk):
             )
             return
 
-        # Get save path
+        # Only one export at a time
+        if self._export_thread and self._export_thread.is_alive():
+            messagebox.showwarning(
+                title="Busy",
+                message="A calibration file is still being saved!"
+            )
+            return
+
+        # Get save path (asksaveasfile would create an empty file)
+        file_path = filedialog.asksaveasfilename(
+            initialfile = filename,
+            defaultextension='.wav',
+            filetypes=[
+                ('WAV', '*.wav'), 
+                ('FLAC (lossless compressed)', '*.flac'),
+                ('Wave64 (over 4 GB)', '*.w64'), 
+                ('RF64 (over 4 GB)', '*.rf64')
+            ])
+        if not file_path:
+            return
+
+        # Write calibration file (shaping options in the metadata) 
+        # in the background
+        self._export_progress = (0.0, 0)
+        self._export_result = None
+        self._export_error = None
+        self._export_start = time.perf_counter()
+        self._export_thread = threading.Thread(
+            target=self._write_export,
+            args=(file_path, self.cal_noise, self.a.fs, 
+                dict(self.shaping_info), self._settings['subtype'].get(),
+                self.a.subtype, self._settings['compression'].get()),
+            daemon=True
+        )
+        self._export_thread.start()
+        self._check_export(file_path)
+
+
+    def _write_export(self, file_path, data, fs, metadata, subtype, 
+            source_subtype, compression):
+        """ Worker thread: write the calibration file. Does not 
+            touch Tk; progress is shown by _check_export().
+        """
+        def progress(fraction, num_bytes):
+            self._export_progress = (fraction, num_bytes)
+
         try:
-            file_path = filedialog.asksaveasfile(
-                initialfile = filename,
-                defaultextension='.wav').name
-        except AttributeError:
+            self._export_result = writemodel.write(file_path, data, fs, 
+                metadata=metadata, subtype=subtype, 
+                source_subtype=source_subtype, progress=progress,
+                channel_major=True,
+                compression=compression)
+        except Exception as e:
+            self._export_error = e
+
+
+    def _check_export(self, file_path):
+        """ Poll the background export and report progress and 
+            throughput.
+        """
+        fraction, num_bytes = self._export_progress
+        elapsed = max(time.perf_counter() - self._export_start, 1e-6)
+        rate = num_bytes / elapsed / 1e6
+        if self._export_thread.is_alive():
+            self.status_var.set("Status: Saving " +
+                f"{os.path.basename(file_path)} ({int(fraction*100)}%, " +
+                f"{np.round(rate, 1)} MB/s)")
+            self.progress_var.set(fraction * 100)
+            self.after(100, self._check_export, file_path)
+            return
+
+        self.progress_var.set(0)
+        self.status_var.set("Status: Ready")
+        if self._export_error:
+            messagebox.showerror(
+                title="Export Failed",
+                message="Could not save the calibration file!",
+                detail=str(self._export_error)
+            )
             return
-            
-        # Write calibration file    
-        sf.write(file_path, df, self.a.fs)
 
         # Update labels with exported audio info
-        self._vars["out_file"].set(f"Name: {filename}")
-        self._vars["out_datatype"].set(f"Data Type: {str(df.dtypes[0])}")
+        self._vars["out_file"].set(f"Name: {os.path.basename(file_path)}")
+        self._vars["out_datatype"].set(f"Data Type: {self._export_result}")
         self._vars["out_samplingrate"].set(f"Sampling Rate: {self.a.fs} Hz")
-        self._vars["out_channels"].set(f"Channels: {len(df.columns)}")
+        self._vars["out_channels"].set(
+            f"Channels: {self.cal_noise.shape[0]}")
 
         # Feedback to user
+        self.status_var.set(f"Status: Saved {np.round(num_bytes/1e6, 1)} " +
+            f"MB at {np.round(rate, 1)} MB/s")
         messagebox.showinfo(title="Success", 
             message="Save successful!")
 
@@ -247,9 +424,10 @@ class Application(tk.Tk):
     ########################
     # Tools Menu Functions #
     ########################
-    def _shape_noise(self):
-        """ Create NoiseShaper class to create filtered noise. """
-        # First check that an audio file was loaded
+    def _check_audio(self):
+        """ Check that an audio file was imported and has finished 
+            loading. Shows a message if not.
+        """
         try:
             self.a.name
         except:
@@ -257,39 +435,162 @@ class Application(tk.Tk):
                 title="File Not Found!",
                 message="Please import an audio file first!"
             )
+            return False
+
+        # Wait for the background import
+        if not self.a.loaded:
+            messagebox.showwarning(
+                title="Loading",
+                message="The audio file is still loading!"
+            )
+            return False
+        return True
+
+
+    def _shape_noise(self):
+        """ Create a fast preview of the calibration noise, then 
+            render the full-quality noise in the background.
+        """
+        # First check that an audio file was loaded
+        if not self._check_audio():
             return
 
-        for ii in range(0, len(self.a.channels)):
-            self.status_var.set(f"Status: Processing channel {ii+1} of " +
-                                f"{len(self.a.channels)}")
-            self.update_idletasks()
+        # Only one render at a time
+        if self._render_thread and self._render_thread.is_alive():
+            messagebox.showwarning(
+                title="Busy",
+                message="A calibration file is still being created!"
+            )
+            return
+
+        # Read Tk settings on the main thread
+        correlated = self._settings['noise_type'].get()
+        options = self._shaping_options()
+
+        # Preview, then full-quality render, in the background
+        self._render_done = False
+        self.status_var.set("Status: Creating preview" 
+            if options.get('preset') != 'preview' 
+            else "Status: Creating calibration noise")
+        self.cal_noise = None
+        self._preview_results = None
+        self._render_results = []
+        self._render_buffer = None
+        self._render_error = None
+        self._render_thread = threading.Thread(
+            target=self._render_full, 
+            args=(self.a, correlated, options),
+            daemon=True
+        )
+        self._render_thread.start()
+        self.after(100, self._check_render)
+
+
+    def _render_full(self, audio, correlated, options):
+        """ Worker thread: render a quick preview from a sampled 
+            stimulus spectrum, then every channel at full quality 
+            from one full analysis of the stimulus. Does not touch 
+            Tk; results are collected by _check_render().
+        """
+        try:
+            if options.get('preset') != 'preview':
+                # Preview: short, low resolution, frequency-domain 
+                # synthesis from randomly sampled segments
+                preview = noisemodel.preset_options('preview')
+                preview['loopable'] = options.get('loopable', False)
+                spectrum = spectrummodel.estimate(audio.signal, audio.fs,
+                    nperseg=preview['nperseg'])
+                self._preview_results = list(noisemodel.shape_channels(
+                    audio=None,
+                    fs=audio.fs,
+                    correlated=correlated,
+                    spectrum=spectrum,
+                    **preview
+                ))
+
+            # Full resolution stimulus spectrum, analysed once
+            spectrum = spectrummodel.analyse(audio.data, audio.fs, 
+                nperseg=options.get('nperseg', 2048), channel_major=True)
+            results = noisemodel.shape_channels(
+                audio=None,
+                fs=audio.fs,
+                correlated=correlated,
+                spectrum=spectrum,
+                **options
+            )
+            for ii, result in results:
+                # Fill the output buffer in place as channels finish
+                if self._render_buffer is None:
+                    self._render_buffer = np.empty(
+                        (audio.num_channels, len(result.noise)))
+                self._render_buffer[ii] = result.noise
+                result.noise = None
+                self._render_results.append((ii, result))
+        except Exception as e:
+            self._render_error = e
+
+
+    def _check_render(self):
+        """ Poll the background render. Shows the preview once it 
+            is ready and swaps in the full results once it finishes.
+        """
+        if self._preview_results is not None:
+            results, self._preview_results = self._preview_results, None
+            self._store_results(results)
+            self.status_var.set("Status: Preview shown")
+
+        if self._render_thread.is_alive():
+            if self.cal_noise is not None:
+                self.status_var.set("Status: Preview shown. Rendering " +
+                    f"channel {len(self._render_results)+1} of " +
+                    f"{len(self.a.channels)}...")
+            self.after(100, self._check_render)
+            return
+
+        if self._render_error:
+            self.status_var.set("Status: Ready")
+            messagebox.showerror(
+                title="Render Failed",
+                message="Could not create the calibration file!",
+                detail=str(self._render_error)
+            )
+            return
+
+        self._store_results(self._render_results, self._render_buffer)
+        self._render_results = []
+        self._render_buffer = None
+        self._finish_render()
 
-            # Create shaped noise
-            if self.a.num_channels > 1:
-                #print("controller: Found multi-channel audio")
-                self.n.shape_noise(
-                    audio=self.a.signal[:, ii],
-                    fs=self.a.fs,
-                    correlated=self._settings['noise_type'].get()
-                )
-            elif self.a.num_channels == 1:
-                #print("controller: Found single-channel audio")
-                self.n.shape_noise(
-                    audio=self.a.signal,
-                    fs=self.a.fs,
-                    correlated=self._settings['noise_type'].get()
-                )
-
-            # Fill dicts with iteration values
-            self.filtered_noises[ii] = self.n.adj_filtered_noise
-            self.noise_pwelch[ii] = (self.n.f_adj_filt_noise, 
-                self.n.den_adj_filt_noise)
-            self.stim_pwelch[ii] = (self.n.f_stim, self.n.den_stim)
-
-            # Plot spectra
-            self._plot_spectra(channel=ii)
-            self.update_idletasks()
 
+    def _store_results(self, results, cal_noise=None):
+        """ Fill the per-channel dicts and plot each channel. 
+            CAL_NOISE is an already filled channel-major (C, N) 
+            output array; otherwise one is preallocated and each 
+            channel's noise is copied into its row as it arrives.
+        """
+        self.plot_cache.clear()
+        self.cal_noise = cal_noise
+        for ii, result in results:
+            # Fill output array and dicts with iteration values
+            if self.cal_noise is None:
+                self.cal_noise = np.empty(
+                    (self.a.num_channels, len(result.noise)))
+            if result.noise is not None:
+                self.cal_noise[ii] = result.noise
+            self.shaping_info = result.info
+            self.noise_pwelch[ii] = (result.f_noise, result.den_noise)
+            self.stim_pwelch[ii] = (result.f_stim, result.den_stim)
+            self.plot_cache.set(ii, 'noise', result.f_noise, result.den_noise)
+            self.plot_cache.set(ii, 'stim', result.f_stim, result.den_stim)
+
+        # Plot spectra of the selected channel
+        self._plot_spectra()
+        self.update_idletasks()
+
+
+    def _finish_render(self):
+        """ Unlock export and prompt to save. """
+        self._render_done = True
         self.status_var.set(f"Status: Ready")
 
         # Prompt save
@@ -302,35 +603,94 @@ class Application(tk.Tk):
             return
 
 
-    def _plot_spectra(self, channel):
+    def _live_noise(self):
+        """ Start or stop real-time shaped noise on the audio 
+            device, following the selected channel's spectrum.
+        """
+        if self._live is not None:
+            self._live.stop()
+            print(f"controller: Live noise CPU budget: {self._live.report()}")
+            self._live = None
+            self.status_var.set("Status: Ready")
+            return
+
+        if not self._check_audio():
+            return
+
+        # Stimulus spectrum of the selected channel
+        channel = self.main_view.selected_channel()
+        spectrum = spectrummodel.analyse(self.a.data[channel:channel+1], 
+            self.a.fs, channel_major=True).channel(0)
+        engine = self._settings['engine'].get()
+        try:
+            self._live = livemodel.LiveNoise(
+                spectrum, 
+                self.a.fs,
+                channels=min(self.a.num_channels, self.a.num_outputs),
+                correlated=self._settings['noise_type'].get(),
+                engine=engine if engine in ('iir', 'fir') else 'iir',
+                tolerance=self._settings['tolerance'].get() or None,
+                smoothing=self._settings['smoothing'].get() or None
+            )
+            self._live.start()
+        except Exception as e:
+            self._live = None
+            messagebox.showerror(
+                title="Live Noise Failed",
+                message="Could not start live noise!",
+                detail=str(e)
+            )
+            return
+        self._check_live()
+
+
+    def _check_live(self):
+        """ Show the live generator's CPU budget while it runs. """
+        if self._live is None:
+            return
+        report = self._live.report()
+        self.status_var.set("Status: Live noise " +
+            f"(CPU {int(report['mean_load']*100)}% of " +
+            f"{np.round(report['block_ms'], 1)} ms blocks, " +
+            f"{report['underflows']} underflows)")
+        self.after(500, self._check_live)
+
+
+    def _shaping_options(self):
+        """ Collect shape_noise() options from the Tools menu. A 
+            preset sets the filter, resolution and duration; 
+            Loopable still applies.
+        """
+        preset = self._settings['preset'].get()
+        if preset != 'custom':
+            loopable = self._settings['loopable'].get()
+            return noisemodel.preset_options(preset, fs=self.a.fs, 
+                num_samples=self.a.frames, 
+                num_channels=self.a.num_channels,
+                overrides={'loopable': loopable or None})
+
+        return {
+            'engine': self._settings['engine'].get(),
+            'tolerance': self._settings['tolerance'].get() or None,
+            'smoothing': self._settings['smoothing'].get() or None,
+            'loopable': self._settings['loopable'].get(),
+            'duration': self._settings['duration'].get()
+        }
+
+
+    def _plot_spectra(self, channel=None):
         """ Plot spectrum of original audio and shaped noise 
-            for visual inspection.
+            for visual inspection. Defaults to the channel chosen 
+            in the plot's channel selector.
         """
-        # Create figure object
-        self.fig = Figure(figsize=(5.5,4), dpi=75)
-        self.ax = self.fig.add_subplot(1,1,1)
-
-        # Create stimulus axes
-        self.ax.plot(self.stim_pwelch[channel][0],
-            20*np.log10(self.stim_pwelch[channel][1]), color="blue", 
-            label="stimulus", linewidth=3)
-
-        # Create noise axes
-        self.ax.plot(self.noise_pwelch[channel][0],
-            20*np.log10(self.noise_pwelch[channel][1]), 
-            ls=":", linewidth=3, color="orange", label="Filtered Noise")
-
-        # Set axis labels
-        self.ax.set_xlabel("Frequency (Hz)")
-        self.ax.set_ylabel("Power Spectral Density")
-        self.ax.set_title(f"Power Spectral Density for Channel {channel+1}")
-        self.ax.legend()
-
-        self.canvas = FigureCanvasTkAgg(self.fig, 
-            master=self.main_view.lblfrm_plots)
-        self.canvas.get_tk_widget().grid(column=0, row=5)
-
-        self.update()
+        if channel is None:
+            channel = self.main_view.selected_channel()
+        stim = self.plot_cache.get(channel, 'stim')
+        noise = self.plot_cache.get(channel, 'noise')
+        if stim is None or noise is None:
+            return
+
+        self.main_view.plot_spectra(channel, stim=stim, noise=noise)
 
 
     #######################
@@ -5,6 +5,9 @@
 import tkinter as tk
 from tkinter import messagebox
 
+# Import system packages
+import os
+
 class MainMenu(tk.Menu):
     """ Main Menu
     """
@@ -40,6 +43,33 @@ class MainMenu(tk.Menu):
             label="Export Cal File...",
             command=self._event('<<FileExport>>')
         )
+        # Output sample format
+        format_menu = tk.Menu(file_menu, tearoff=False)
+        formats = [
+            ('Match Input', 'match'), 
+            ('16-bit PCM', 'PCM_16'), 
+            ('24-bit PCM', 'PCM_24'), 
+            ('32-bit PCM', 'PCM_32'), 
+            ('32-bit Float', 'FLOAT')
+        ]
+        for label, value in formats:
+            format_menu.add_radiobutton(
+                label=label,
+                value=value,
+                variable=self._settings['subtype']
+            )
+        file_menu.add_cascade(label="Export Format", menu=format_menu)
+        # FLAC compression level (lossless)
+        compression_menu = tk.Menu(file_menu, tearoff=False)
+        levels = [('0 (Fastest)', 0), ('5 (Default)', 5), ('8 (Smallest)', 8)]
+        for label, value in levels:
+            compression_menu.add_radiobutton(
+                label=label,
+                value=value,
+                variable=self._settings['compression']
+            )
+        file_menu.add_cascade(label="FLAC Compression", 
+            menu=compression_menu)
         file_menu.add_separator()
         file_menu.add_command(
             label="Quit",
@@ -57,6 +87,10 @@ class MainMenu(tk.Menu):
             label='Create Cal File',
             command=self._event('<<ToolsShapeNoise>>')
         )
+        tools_menu.add_command(
+            label='Start/Stop Live Noise',
+            command=self._event('<<ToolsLiveNoise>>')
+        )
         tools_menu.add_separator()
         tools_menu.add_radiobutton(
             label='Correlated',
@@ -70,6 +104,105 @@ class MainMenu(tk.Menu):
             value=False,
             variable=self._settings['noise_type']
         )
+        tools_menu.add_separator()
+        # Speed/accuracy presets (override the filter and duration
+        # settings below; Loopable still applies)
+        preset_menu = tk.Menu(tools_menu, tearoff=False)
+        presets = [
+            ('Custom', 'custom'), 
+            ('Preview', 'preview'), 
+            ('Standard', 'standard'), 
+            ('Reference', 'reference'),
+            ('Time Budget: 1 s', 'budget:1'),
+            ('Time Budget: 10 s', 'budget:10')
+        ]
+        for label, value in presets:
+            preset_menu.add_radiobutton(
+                label=label,
+                value=value,
+                variable=self._settings['preset']
+            )
+        tools_menu.add_cascade(label='Preset', menu=preset_menu)
+        # Calibration noise duration
+        duration_menu = tk.Menu(tools_menu, tearoff=False)
+        duration_menu.add_radiobutton(
+            label='Match Stimulus',
+            value='match',
+            variable=self._settings['duration']
+        )
+        for dur in ('5', '10', '30'):
+            duration_menu.add_radiobutton(
+                label=f'{dur} s',
+                value=dur,
+                variable=self._settings['duration']
+            )
+        for std in ('0.5', '1'):
+            duration_menu.add_radiobutton(
+                label=f'Minimum for PSD \u00B1{std} dB',
+                value=f'psd:{std}',
+                variable=self._settings['duration']
+            )
+        tools_menu.add_cascade(label='Duration', menu=duration_menu)
+        tools_menu.add_checkbutton(
+            label='Loopable',
+            variable=self._settings['loopable']
+        )
+        tools_menu.add_separator()
+        # Number of threads used to process channels
+        workers_menu = tk.Menu(tools_menu, tearoff=False)
+        for num in self._worker_options():
+            workers_menu.add_radiobutton(
+                label=str(num),
+                value=num,
+                variable=self._settings['workers']
+            )
+        tools_menu.add_cascade(label='Threads', menu=workers_menu)
+        # Filter engine
+        engine_menu = tk.Menu(tools_menu, tearoff=False)
+        engine_menu.add_radiobutton(
+            label='FIR',
+            value='fir',
+            variable=self._settings['engine']
+        )
+        engine_menu.add_radiobutton(
+            label='IIR (LPC)',
+            value='iir',
+            variable=self._settings['engine']
+        )
+        engine_menu.add_radiobutton(
+            label='Spectral (FFT Synthesis)',
+            value='spectral',
+            variable=self._settings['engine']
+        )
+        tools_menu.add_cascade(label='Filter Engine', menu=engine_menu)
+        # Filter length: fixed or shortest meeting a tolerance
+        taps_menu = tk.Menu(tools_menu, tearoff=False)
+        taps_menu.add_radiobutton(
+            label='Fixed',
+            value=0.0,
+            variable=self._settings['tolerance']
+        )
+        for tol in (0.5, 1.0, 2.0):
+            taps_menu.add_radiobutton(
+                label=f'Auto (\u00B1{tol} dB)',
+                value=tol,
+                variable=self._settings['tolerance']
+            )
+        tools_menu.add_cascade(label='Filter Length', menu=taps_menu)
+        # Spectrum smoothing before filter design
+        smoothing_menu = tk.Menu(tools_menu, tearoff=False)
+        smoothing_menu.add_radiobutton(
+            label='None',
+            value=0,
+            variable=self._settings['smoothing']
+        )
+        for fraction in (3, 6, 12):
+            smoothing_menu.add_radiobutton(
+                label=f'1/{fraction} Octave',
+                value=fraction,
+                variable=self._settings['smoothing']
+            )
+        tools_menu.add_cascade(label='Smoothing', menu=smoothing_menu)
         # Add Tools menu to the menubar
         self.add_cascade(label="Tools", menu=tools_menu)
 
@@ -99,6 +232,16 @@ class MainMenu(tk.Menu):
     ##################
     # Menu Functions #
     ##################
+    # TOOLS menu
+    @staticmethod
+    def _worker_options():
+        """ Powers of two up to (and including) the CPU count. """
+        num_cpus = os.cpu_count() or 1
+        options = [2**x for x in range(num_cpus.bit_length())
+            if 2**x < num_cpus]
+        return options + [num_cpus]
+
+
     # HELP menu
     def show_about(self):
         """ Show the about dialog """
@@ -13,7 +13,11 @@ import os
 
 # Import audio packages
 import soundfile as sf
-import sounddevice as sd
+try:
+    import sounddevice as sd
+except OSError:
+    # PortAudio is missing: files can be read but not played
+    sd = None
 
 
 #########
@@ -23,12 +27,15 @@ class Audio:
     """ Class for use with .wav files.
     """
 
-    def __init__(self, file_path, device_id=None):
-        """ Read audio file and generate info.
+    def __init__(self, file_path, device_id=None, load=True):
+        """ Read audio file header and (optionally) samples.
 
             Arguments:
             file_path: a Path object from pathlib
             device_id: audio device querried from sounddevice for playback
+            load: read the samples now. If False, only the header 
+                is read; call load() (e.g., from a worker thread) 
+                before using self.data or self.signal.
         """
         print(f"\naudiomodel: Attempting to load audio file...")
         # Parse file path
@@ -36,89 +43,217 @@ class Audio:
         self.name = os.path.basename(file_path)
         self.file_path = file_path
 
-        # Assign default audio device
-        if not device_id:
-            self.device_id = sd.default.device
-            self.num_outputs = sd.query_devices(sd.default.device[1])['max_output_channels']
-        else:
-            self.device_id = device_id
-            self.num_outputs = sd.query_devices(self.device_id)['max_output_channels']
+        # Audio device is queried on first playback
+        self._device_id = device_id
+        self._num_outputs = None
 
-        # Read audio file
+        # Read audio file header
         file_exists = os.access(self.file_path, os.F_OK)
         if not file_exists:
             print("audiomodel: Audio file not found!")
             raise FileNotFoundError
         else:
             try:
-                self.signal, self.fs = sf.read(self.file_path)
+                header = sf.info(self.file_path)
                 print("audiomodel: Audio file found")
-            except sf.LibsndfileError:
+            except (sf.LibsndfileError, RuntimeError):
                 print("audiomodel: No file imported!")
                 raise FileNotFoundError
 
         # Get number of channels
-        try:
-            self.num_channels = self.signal.shape[1]
-        except IndexError:
-            self.num_channels = 1
+        self.fs = header.samplerate
+        self.frames = header.frames
+        self.num_channels = header.channels
         self.channels = np.array(range(1, self.num_channels+1))
         print(f"audiomodel: Number of channels: {self.num_channels}")
 
         # Assign audio file attributes
-        self.dur = len(self.signal) / self.fs
-        self.t = np.arange(0, self.dur, 1/self.fs)
+        self.dur = self.frames / self.fs
         print(f"audiomodel: Duration: {np.round(self.dur, 2)} seconds " +
             f"({np.round(self.dur/60, 2)} minutes)")
 
-        # Get data type
-        self.data_type = self.signal.dtype
-        print(f"audiomodel: Data type: {self.data_type}")
+        # Get data type (samples are read as float64)
+        self.subtype = header.subtype
+        self.data_type = np.dtype('float64')
+        print(f"audiomodel: Data type: {self.data_type} " +
+            f"(stored as {self.subtype})")
+
+        # Samples, stored channel-major (see load())
+        self.data = None
+        self.progress = 0.0
+        if load:
+            self.load()
+
+
+    def load(self, blocksize=2**18, out=None):
+        """ Read the samples into a preallocated channel-major 
+            (C, N) array. Each interleaved block from the file is 
+            transposed into place as it is read, so the conversion 
+            happens once and every channel is contiguous. 
+            self.progress (0-1) is updated after each block so 
+            another thread can display it.
+
+            out: a (C, N) float64 array to decode into (e.g., 
+                shared memory) instead of allocating one. If the 
+                file holds fewer frames than its header says, 
+                self.data is a view of the filled part.
+        """
+        shape = (self.num_channels, self.frames)
+        if out is None:
+            data = np.empty(shape, dtype=self.data_type)
+        elif out.shape != shape or out.dtype != self.data_type:
+            raise ValueError(f"Expected a {shape} {self.data_type} " +
+                f"buffer, not {out.shape} {out.dtype}")
+        else:
+            data = out
+        buffer = np.empty((min(blocksize, max(self.frames, 1)), 
+            self.num_channels), dtype=self.data_type)
+
+        read = 0
+        with sf.SoundFile(self.file_path) as f:
+            while read < self.frames:
+                block = f.read(out=buffer[:self.frames - read])
+                if len(block) == 0:
+                    break
+                data[:, read:read+len(block)] = block.T
+                read += len(block)
+                self.progress = read / self.frames
 
+        # Header frame counts can be wrong for some formats
+        if read < self.frames:
+            data = data[:, :read] if out is not None \
+                else np.ascontiguousarray(data[:, :read])
+        self.data = data
+        self.frames = read
+        self.dur = self.frames / self.fs
+        self.progress = 1.0
         print("audiomodel: Done!")
 
 
-    def play(self, level=None):
-        """ Present working audio
+    @property
+    def loaded(self):
+        return self.data is not None
+
+
+    @property
+    def signal(self):
+        """ Samples as read by soundfile: 1-D for one channel, 
+            otherwise (N, C). A transposed view of self.data, not 
+            a copy; columns are contiguous, so prefer self.data 
+            for per-channel processing.
         """
-        # Create a temporary signal to be modified
-        temp = self.signal.copy()
+        if self.data is None:
+            return None
+        return self.data[0] if self.num_channels == 1 else self.data.T
+
+
+    @property
+    def t(self):
+        """ Time vector (computed on request). """
+        return np.arange(0, self.frames) / self.fs
+
+
+    @property
+    def device_id(self):
+        if not self._device_id:
+            self._device_id = sd.default.device
+        return self._device_id
 
-        # Get presentation level
+
+    @property
+    def num_outputs(self):
+        """ Output channels of the playback device (queried once). """
+        if self._num_outputs is None:
+            if not self._device_id:
+                device = sd.default.device[1]
+            else:
+                device = self._device_id
+            self._num_outputs = sd.query_devices(device)[
+                'max_output_channels']
+        return self._num_outputs
+
+
+    def gains(self, level=None):
+        """ Per-channel (offset, gain) for playback, computed once 
+            without copying the signal.
+
+            No level: remove DC offset, normalize each channel and 
+                account for the number of channels
+            level: scale every channel by LEVEL
+        """
+        x = self.data
         if not level:
-            for chan in range(0, self.num_channels):
-                # remove DC offset
-                temp[:, chan] = temp[:, chan] - np.mean(temp[:, chan]) 
-                # normalize
-                temp[:, chan] = temp[:, chan] / np.max(np.abs(temp[:, chan]))
-                # account for num channels
-                temp[:, chan] = temp[:, chan] / self.num_channels 
-                #print(f"\nMax of signal: {np.max(np.abs(self.signal[:, chan]))}")
-                #print(f"Max of temp: {np.max(np.abs(temp[:, chan]))}")
+            offset = x.mean(axis=1)
+            peak = np.maximum(x.max(axis=1) - offset, offset - x.min(axis=1))
+            peak[peak == 0] = 1
+            gain = 1 / (peak * self.num_channels)
         else:
-            self.level = level
-            # Apply presentation level
-            for chan in range(0, self.num_channels):
-                temp[:, chan] = temp[:, chan] * self.level
-                #print(f"\nMax of signal: {np.max(np.abs(self.signal[:, chan]))}")
-                #print(f"Max of temp: {np.max(np.abs(temp[:, chan]))}")
+            offset = np.zeros(self.num_channels)
+            gain = np.full(self.num_channels, float(level))
+        return offset, gain
 
-        # Make modified signal available for testing
-        self.sig = temp
 
-        # Present audio
+    def play(self, level=None, blocksize=1024):
+        """ Present working audio. Blocks are read, scaled and 
+            mapped to the device outputs inside the stream callback, 
+            so playback starts immediately and no copy of the signal 
+            is made.
+        """
+        if sd is None:
+            raise RuntimeError("No audio device library (PortAudio) found")
+        if level:
+            self.level = level
+        self.stop()
+
+        # Drop channels the device cannot play
+        num_out = self.num_channels
         if self.num_outputs < self.num_channels:
             print(f"\naudiomodel: {self.num_channels}-channel file, but "
                 f"only {self.num_outputs} audio device output channels!")
             print("audiomodel: Dropping " +
                 f"{self.num_channels - self.num_outputs} audio file channels")
-            sd.play(temp[:, 0:self.num_outputs], mapping=self.channels[0:self.num_outputs])
-        else:
-            sd.play(temp.T, self.fs, mapping=self.channels)
-            #sd.wait(self.dur+0.5)
+            num_out = self.num_outputs
+
+        offset, gain = self.gains(level)
+        offset, gain = offset[:num_out], gain[:num_out]
+        x = self.data[:num_out]
+        self.position = 0
+        self._stop_at = self.frames
+
+        def callback(outdata, frames, time, status):
+            if status:
+                print(f"audiomodel: {status}")
+            start = self.position
+            stop = min(start + frames, self._stop_at)
+            n = max(stop - start, 0)
+            # Interleave one block for the device
+            outdata[:n] = ((x[:, start:stop] - offset[:, None]) 
+                * gain[:, None]).T
+            outdata[n:] = 0
+            self.position = start + n
+            if self.position >= self._stop_at:
+                raise sd.CallbackStop
+
+        self._stream = sd.OutputStream(
+            samplerate=self.fs,
+            channels=num_out,
+            dtype='float32',
+            blocksize=blocksize,
+            device=self._device_id,
+            callback=callback
+        )
+        self._stream.start()
 
 
     def stop(self):
-        """ Stop audio presentation.
+        """ Stop audio presentation. Output ends at the block 
+            boundary of the current position; no further samples 
+            are written.
         """
-        sd.stop()
+        stream = getattr(self, '_stream', None)
+        if stream is None:
+            return
+        self._stop_at = self.position
+        stream.abort()
+        stream.close()
+        self._stream = None
@@ -0,0 +1,131 @@
+""" Central performance configuration for every spectral stage
+    (Welch, convolution and any future FFT engines). One setting
+    controls how many threads a shaping job may use.
+
+    Usage:
+        from models import fftmodel
+        fftmodel.configure(workers=8)
+        with fftmodel.fft_workers():
+            f, den = fftmodel.welch(x, fs, nperseg=2048)
+"""
+
+###########
+# Imports #
+###########
+# Data Science
+import numpy as np
+from scipy import fft as sp_fft
+from scipy import signal
+
+# System
+import os
+from contextlib import contextmanager
+from functools import lru_cache
+
+
+#########
+# BEGIN #
+#########
+class FFTConfig:
+    """ Performance settings shared by NoiseShaper, the batch
+        runner and the GUI.
+
+        workers: total number of threads a shaping job may use
+        fast_len: pad/round FFT lengths to sizes that factor into
+            small primes, where the caller is free to do so
+        cache: reuse windows (and, through repeated fast lengths,
+            scipy.fft's internal plan cache) across calls
+    """
+    def __init__(self, workers=None, fast_len=True, cache=True):
+        self.workers = workers or os.cpu_count() or 1
+        self.fast_len = fast_len
+        self.cache = cache
+
+
+# Module-level configuration used by all spectral stages
+config = FFTConfig()
+
+
+def configure(workers=None, fast_len=None, cache=None):
+    """ Update the global configuration. Arguments left as None
+        keep their current value.
+    """
+    if workers is not None:
+        config.workers = max(1, int(workers))
+    if fast_len is not None:
+        config.fast_len = bool(fast_len)
+    if cache is not None:
+        config.cache = bool(cache)
+        if not config.cache:
+            _cached_window.cache_clear()
+    print(f"fftmodel: workers={config.workers}, " +
+        f"fast_len={config.fast_len}, cache={config.cache}")
+
+
+def split_workers(num_tasks, workers=None):
+    """ Divide the thread budget between concurrent tasks.
+
+        :returns: (number of task threads, FFT workers per task)
+    """
+    if not workers:
+        workers = config.workers
+    workers = max(1, int(workers))
+    threads = max(1, min(workers, num_tasks))
+    return threads, max(1, workers // threads)
+
+
+@contextmanager
+def fft_workers(workers=None):
+    """ Set the default scipy.fft worker count for the current
+        thread. Defaults to the global configuration.
+    """
+    if not workers:
+        workers = config.workers
+    with sp_fft.set_workers(workers):
+        yield
+
+
+def fast_len(n):
+    """ Return a fast real-FFT length >= N (or N itself if
+        fast lengths are disabled).
+    """
+    if config.fast_len:
+        return sp_fft.next_fast_len(int(n), real=True)
+    return int(n)
+
+
+@lru_cache(maxsize=32)
+def _cached_window(window, nperseg):
+    win = signal.get_window(window, nperseg)
+    win.flags.writeable = False
+    return win
+
+
+def get_window(window, nperseg):
+    """ Return a (possibly cached, read-only) window array. """
+    if config.cache:
+        return _cached_window(window, nperseg)
+    return signal.get_window(window, nperseg)
+
+
+def welch(x, fs, nperseg=2048, window='hann', **kwargs):
+    """ scipy.signal.welch using a cached window. Honours the
+        worker count set by fft_workers().
+    """
+    nperseg = min(nperseg, np.shape(x)[kwargs.get('axis', -1)])
+    return signal.welch(x, fs, window=get_window(window, nperseg),
+        nperseg=nperseg, **kwargs)
+
+
+def convolve(in1, in2, mode='full', method='fft'):
+    """ Convolution. Honours the worker count set by
+        fft_workers().
+
+        method: 'fft' (one large FFT), 'oa' (overlap-add, faster
+            for short filters on long signals) or 'direct'
+    """
+    if method == 'oa':
+        return signal.oaconvolve(in1, in2, mode=mode)
+    if method == 'direct':
+        return signal.convolve(in1, in2, mode=mode, method='direct')
+    return signal.fftconvolve(in1, in2, mode=mode)
@@ -0,0 +1,318 @@
+""" Real-time shaped noise. A shaping filter is designed from
+    the stimulus PSD once; noise is then generated, filtered and
+    scaled block by block inside a sounddevice output callback,
+    so a calibration signal can run at a rig indefinitely
+    without writing a file.
+
+    Usage:
+        spectrum = spectrummodel.analyse(audio, fs)
+        live = livemodel.LiveNoise(spectrum.channel(0), fs)
+        live.start()
+        ...
+        live.stop()
+        print(live.report())
+
+        # Without an audio device
+        live = livemodel.LiveNoise(spectrum.channel(0), fs,
+            stream=livemodel.FileStream('live.wav', max_blocks=1000))
+"""
+
+###########
+# Imports #
+###########
+# Data Science
+import numpy as np
+from scipy import fft as sp_fft
+from scipy import signal
+
+# System
+import time
+import threading
+
+# Audio
+import soundfile as sf
+try:
+    import sounddevice as sd
+except OSError:
+    # PortAudio is missing: only the stand-in streams can be used
+    sd = None
+
+# Custom
+from models import noisemodel
+
+
+#########
+# BEGIN #
+#########
+class LiveNoise:
+    """ Continuous shaped noise for an output stream.
+
+        spectrum: single-channel spectrummodel.Spectrum of the
+            stimulus (sets the filter and the output RMS)
+        channels: number of output channels
+        correlated: same noise on every channel, otherwise one
+            independent noise per channel
+        engine: 'iir' (low-order all-pole model, state carried
+            between blocks) or 'fir' (uniformly partitioned
+            overlap-save convolution, one block of latency)
+        blocksize: frames per callback
+        stream: an object with the sd.OutputStream interface
+            (e.g., NullStream or FileStream). Default: the audio
+            device.
+    """
+    def __init__(self, spectrum, fs, channels=1, correlated=True,
+            engine='iir', order=None, tolerance=None, smoothing=None,
+            blocksize=512, seed=None, stream=None, device=None):
+        if engine not in ('iir', 'fir'):
+            raise ValueError(f"Engine {engine} cannot run in real time")
+
+        self.fs = fs
+        self.channels = channels
+        self.blocksize = blocksize
+        self.device = device
+        self._stream = stream
+
+        # Design the filter once
+        self.filter = noisemodel.design_filter(spectrum.f, spectrum.den,
+            fs, engine=engine, tolerance=tolerance, smoothing=smoothing,
+            order=order)
+
+        # Gain that gives unit-variance noise the stimulus RMS
+        self.gain = spectrum.rms / np.sqrt(self._noise_power())
+
+        # Generator and filter state
+        self._rng = np.random.default_rng(seed)
+        self._streams = 1 if correlated else channels
+        self._noise = np.empty((blocksize, self._streams))
+        if engine == 'iir':
+            self._zi = np.zeros((len(self.filter.coeffs), 2, self._streams))
+        else:
+            self._conv = PartitionedConvolver(self.filter.coeffs,
+                blocksize, self._streams)
+
+        # CPU budget statistics
+        self.blocks = 0
+        self.overruns = 0
+        self.underflows = 0
+        self._load_sum = 0.0
+        self._load_max = 0.0
+
+
+    def _noise_power(self):
+        """ Output variance of the filter for unit-variance white
+            noise.
+        """
+        if self.filter.engine == 'fir':
+            return np.sum(self.filter.coeffs**2)
+        _, h = signal.sosfreqz(self.filter.coeffs, worN=8192)
+        return np.mean(np.abs(h)**2)
+
+
+    def process(self, frames):
+        """ Generate FRAMES of shaped noise.
+
+            :returns: array of shape (FRAMES, channels)
+        """
+        noise = self._noise[:frames]
+        self._rng.standard_normal(out=noise)
+        if self.filter.engine == 'iir':
+            out, self._zi = signal.sosfilt(self.filter.coeffs, noise,
+                axis=0, zi=self._zi)
+        else:
+            out = self._conv.process(noise)
+        out *= self.gain
+        if self._streams == 1 and self.channels > 1:
+            return np.broadcast_to(out, (frames, self.channels))
+        return out
+
+
+    def callback(self, outdata, frames, time_info, status):
+        """ sounddevice output callback. Records the share of the
+            block period spent generating each block.
+        """
+        start = time.perf_counter()
+        if status and status.output_underflow:
+            self.underflows += 1
+        outdata[:] = self.process(frames)
+
+        load = (time.perf_counter() - start) * self.fs / frames
+        self.blocks += 1
+        self._load_sum += load
+        self._load_max = max(self._load_max, load)
+        if load > 1:
+            self.overruns += 1
+
+
+    def start(self):
+        """ Open the output stream and start playing. """
+        if self._stream is None:
+            if sd is None:
+                raise RuntimeError("No audio device library (PortAudio) " +
+                    "found; use a NullStream or FileStream")
+            self._stream = sd.OutputStream(
+                samplerate=self.fs,
+                channels=self.channels,
+                dtype='float32',
+                blocksize=self.blocksize,
+                latency='low',
+                device=self.device,
+                callback=self.callback
+            )
+        else:
+            self._stream.open(samplerate=self.fs, channels=self.channels,
+                blocksize=self.blocksize, callback=self.callback)
+        print(f"livemodel: Playing {self.filter.engine.upper()}-shaped " +
+            f"noise, {self.blocksize} frames per block " +
+            f"({np.round(1000 * self.blocksize / self.fs, 2)} ms)")
+        self._stream.start()
+
+
+    def stop(self):
+        """ Stop playing and close the stream. """
+        if self._stream is not None:
+            self._stream.stop()
+            self._stream.close()
+        print(f"livemodel: Stopped after {self.blocks} blocks")
+
+
+    def report(self):
+        """ CPU budget per block: mean and max share of the block
+            period used, blocks over budget and device underflows.
+        """
+        return {
+            'blocks': self.blocks,
+            'block_ms': 1000 * self.blocksize / self.fs,
+            'mean_load': self._load_sum / max(self.blocks, 1),
+            'max_load': self._load_max,
+            'overruns': self.overruns,
+            'underflows': self.underflows
+        }
+
+
+class PartitionedConvolver:
+    """ Uniformly partitioned overlap-save convolution. The
+        filter is split into BLOCKSIZE-long partitions whose
+        spectra are multiplied with a delay line of input block
+        spectra, so latency is one block whatever the filter
+        length.
+    """
+    def __init__(self, taps, blocksize, streams=1):
+        self.blocksize = blocksize
+        num_parts = int(np.ceil(len(taps) / blocksize))
+        parts = np.zeros((num_parts, blocksize))
+        parts.flat[:len(taps)] = taps
+        self._h = sp_fft.rfft(parts, 2 * blocksize, axis=1)[:, :, None]
+        self._fdl = np.zeros((num_parts, blocksize + 1, streams),
+            dtype=complex)
+        self._buffer = np.zeros((2 * blocksize, streams))
+        self._index = 0
+
+
+    def process(self, block):
+        """ Filter one block of shape (BLOCKSIZE, streams). """
+        n = self.blocksize
+        self._buffer[:n] = self._buffer[n:]
+        self._buffer[n:] = block
+        self._fdl[self._index] = sp_fft.rfft(self._buffer, axis=0)
+
+        # Newest input spectrum meets the first partition
+        order = (self._index - np.arange(len(self._h))) % len(self._h)
+        spectrum = np.einsum('pks,pks->ks', self._h, self._fdl[order])
+        self._index = (self._index + 1) % len(self._h)
+        return sp_fft.irfft(spectrum, 2 * n, axis=0)[n:]
+
+
+###########################
+# Stand-in Output Streams #
+###########################
+class NullStream:
+    """ Output stream without an audio device. A thread pulls
+        blocks from the callback and discards them, either as
+        fast as possible or paced in REALTIME. Stops after
+        MAX_BLOCKS blocks, if given.
+    """
+    def __init__(self, realtime=False, max_blocks=None):
+        self.realtime = realtime
+        self.max_blocks = max_blocks
+        self._thread = None
+        self._stop = threading.Event()
+
+
+    def open(self, samplerate, channels, blocksize, callback):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.blocksize = blocksize
+        self.callback = callback
+
+
+    @property
+    def active(self):
+        return self._thread is not None and self._thread.is_alive()
+
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+
+    def _run(self):
+        outdata = np.zeros((self.blocksize, self.channels),
+            dtype='float32')
+        period = self.blocksize / self.samplerate
+        deadline = time.perf_counter()
+        count = 0
+        while not self._stop.is_set():
+            if self.max_blocks is not None and count >= self.max_blocks:
+                break
+            self.callback(outdata, self.blocksize, None, None)
+            self.write(outdata)
+            count += 1
+            if self.realtime:
+                deadline += period
+                time.sleep(max(deadline - time.perf_counter(), 0))
+
+
+    def write(self, outdata):
+        pass
+
+
+    def wait(self):
+        """ Block until MAX_BLOCKS have been produced. """
+        self._thread.join()
+
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+    def close(self):
+        pass
+
+
+class FileStream(NullStream):
+    """ Output stream that writes every block to an audio file
+        at PATH instead of the audio device.
+    """
+    def __init__(self, path, realtime=False, max_blocks=None):
+        super().__init__(realtime, max_blocks)
+        self.path = path
+        self._file = None
+
+
+    def open(self, samplerate, channels, blocksize, callback):
+        super().open(samplerate, channels, blocksize, callback)
+        self._file = sf.SoundFile(self.path, 'w', samplerate, channels,
+            subtype='FLOAT')
+
+
+    def write(self, outdata):
+        self._file.write(outdata)
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,4 +1,10 @@
-""" Class that handles shaping white Gaussian noise. """
+""" Functions and classes that handle shaping white Gaussian noise. 
+
+    shape_noise() is a stateless function: it keeps no
+    intermediates and returns a compact ShapedNoise result, so
+    it is safe to call from several threads at once. NoiseShaper 
+    is a thin wrapper kept for existing callers.
+"""
 
 ###########
 # Imports #
@@ -8,278 +14,1012 @@ from tkinter import messagebox
 
 # Data Science
 import numpy as np
-import random
+from scipy import fft as sp_fft
+from scipy import linalg
 from scipy import signal
 
 # System
+import os
 import sys
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Custom
+from models import fftmodel
+from models import spectrummodel
+
+
+#############
+# Constants #
+#############
+# Seed used for correlated noise, so every channel (and every
+# file) receives the same realization
+CORRELATED_SEED = 4
+
+# Speed/accuracy presets: Welch resolution, filter engine and 
+# length, convolution method and output duration
+PRESETS = {
+    'preview': {
+        'nperseg': 512,
+        'engine': 'spectral',
+        'tolerance': None,
+        'smoothing': 6,
+        'method': 'fft',
+        'duration': 2
+    },
+    'standard': {
+        'nperseg': 2048,
+        'engine': 'fir',
+        'tolerance': 0.5,
+        'smoothing': None,
+        'method': 'oa',
+        'duration': 'psd:0.25'
+    },
+    'reference': {
+        'nperseg': 8192,
+        'engine': 'fir',
+        'tolerance': None,
+        'smoothing': None,
+        'method': 'fft',
+        'duration': 30
+    }
+}
+
+# Relative cost per output sample of each preset, used by the 
+# time-budget mode
+_PRESET_COST = {'preview': 0.3, 'standard': 1.0, 'reference': 2.0}
+
+# Measured seconds per output sample of the 'standard' pipeline on
+# this machine (see _seconds_per_sample())
+_calibration = {}
 
 
 #########
 # BEGIN #
 #########
-class NoiseShaper:
-    """ Create filtered noise based on the power spectral
-        density of a given audio signal.
+class ShapedNoise:
+    """ Result of a shaping run. Holds only the output noise, the 
+        stimulus and noise PSDs, and stage timings (seconds).
     """
-    def shape_noise(self, audio, fs, correlated):
-        """ Create white Gaussian noise. Create filter shaped like 
-            the spectrum of the provided audio file. Pass the 
-            noise through the filter. Adjust RMS amplitude of noise 
-            to match RMS amplitude of audio file.
+    __slots__ = ('noise', 'f_stim', 'den_stim', 'f_noise', 'den_noise',
+        'rms_stim', 'timings', 'info')
 
-            :returns: a filtered white Gaussian noise
-        """
-        # Assign public attributes
-        self.audio = audio
-        self.fs = fs
-        self.correlated = correlated
+    def __init__(self, noise, f_stim, den_stim, f_noise, den_noise, 
+            rms_stim, timings=None, info=None):
+        self.noise = noise
+        self.f_stim = f_stim
+        self.den_stim = den_stim
+        self.f_noise = f_noise
+        self.den_noise = den_noise
+        self.rms_stim = rms_stim
+        self.timings = timings if timings is not None else {}
+        self.info = info if info is not None else {}
 
+
+def shape_noise(audio, fs, correlated, seed=None, workers=None,
+        engine='fir', tolerance=None, smoothing=None, order=None,
+        loopable=False, duration=30, spectrum=None, nperseg=2048,
+        method='fft', preset=None, block_segments=None):
+    """ Create white Gaussian noise. Create filter shaped like 
+        the spectrum of the provided audio file. Pass the 
+        noise through the filter. Adjust RMS amplitude of noise 
+        to match RMS amplitude of audio file.
+
+        seed: seed (or SeedSequence) for uncorrelated noise. 
+            Ignored for correlated noise.
+        workers: scipy.fft workers (defaults to the global 
+            fftmodel configuration)
+        engine: 'fir' (linear-phase FIR), 'iir' (low-order 
+            LPC model in second-order sections) or 'spectral' 
+            (frequency-domain synthesis)
+        tolerance: spectral-match tolerance in dB. If given, use 
+            the smallest filter that meets it instead of the fixed 
+            _filter_taps() length (or default IIR order).
+        smoothing: smooth the stimulus PSD to 1/SMOOTHING octave 
+            before designing the filter (e.g., 3, 6, 12)
+        order: IIR model order
+        loopable: filter circularly (one rFFT multiply over the 
+            whole buffer) with no trimming or gating, so the 
+            output loops without clicks. With fast FFT lengths 
+            enabled the duration is rounded up to a fast length.
+        duration: calibration noise duration; see resolve_duration()
+        spectrum: precomputed single-channel Spectrum of the 
+            stimulus (see spectrummodel.analyse()). If given, the 
+            stimulus is not analysed again and AUDIO may be None.
+        nperseg: Welch segment length (frequency resolution)
+        method: FIR convolution method: 'fft', 'oa' or 'direct'
+        preset: name of the preset these options came from (see 
+            preset_options()); recorded in the result info
+        block_segments: compute the output PSD this many Welch 
+            segments at a time (same result, lower peak memory; 
+            see spectrummodel.analyse_blocks())
+
+        :returns: a ShapedNoise result
+    """
+    timings = {}
+    info = {}
+    with fftmodel.fft_workers(workers):
         # Create noise
-        self._create_noise()
+        print("noisemodel: Creating white noise")
+        start = time.perf_counter()
+        num_samples = spectrum.num_samples if spectrum else len(audio)
+        num_noise = noise_length(num_samples, fs, duration, nperseg, 
+            loopable)
+        noise = mk_wgn(fs, num_noise / fs, correlated, seed)
+        timings['noise'] = time.perf_counter() - start
+
+        # P Welch of audio file
+        start = time.perf_counter()
+        if spectrum is None:
+            spectrum = spectrummodel.analyse(audio, fs, nperseg=nperseg)
+            spectrum = spectrum.channel(0)
+        f_stim, den_stim, rms_stim = spectrum.f, spectrum.den, spectrum.rms
+        timings['analysis'] = time.perf_counter() - start
 
-        # Create filtered noise
-        self._create_filter()
+        # Create and apply filter
+        start = time.perf_counter()
+        filtered_noise, filter_info = _create_filter(noise, f_stim, 
+            den_stim, fs, engine=engine, tolerance=tolerance, 
+            smoothing=smoothing, order=order, circular=loopable, 
+            method=method)
+        info.update(filter_info)
+        info['loopable'] = loopable
+        info['duration'] = len(noise) / fs
+        info['nperseg'] = nperseg
+        info['method'] = method
+        info['preset'] = preset
+        del noise
+        timings['filter'] = time.perf_counter() - start
 
-        # Return calibration noise
-        return self.adj_filtered_noise
+        # Equalize RMS
+        start = time.perf_counter()
+        adj_filtered_noise = _correct_amplitude(filtered_noise, rms_stim, 
+            fs, gate=not loopable)
+        del filtered_noise
+        timings['amplitude'] = time.perf_counter() - start
+
+        # Find PSD of final noise
+        start = time.perf_counter()
+        if block_segments:
+            psd = spectrummodel.analyse_blocks(adj_filtered_noise, fs, 
+                nperseg=nperseg, block_segments=block_segments).channel(0)
+            f_noise, den_noise = psd.f, psd.den
+        else:
+            f_noise, den_noise = fftmodel.welch(
+                adj_filtered_noise, fs, nperseg=nperseg)
+        timings['psd'] = time.perf_counter() - start
 
+    return ShapedNoise(
+        noise=adj_filtered_noise,
+        f_stim=f_stim,
+        den_stim=den_stim,
+        f_noise=f_noise,
+        den_noise=den_noise,
+        rms_stim=rms_stim,
+        timings=timings,
+        info=info
+    )
 
-    def _create_noise(self):
-        """ Create and prepare Gaussian noise. """
-        print("noisemodel: Creating white noise")
-        # Create noise
-        self.noise = self.mk_wgn(self.fs, 30)
-        self.dur_noise = len(self.noise) / self.fs
-        self.t_noise = np.arange(0, self.dur_noise, 1/self.fs)
 
-        # P Welch of noise and audio file
-        self.f_stim, self.den_stim = signal.welch(
-            self.audio, self.fs, nperseg=2048)
+def resolve_duration(duration, num_samples, fs, nperseg=2048, 
+        rampdur=0.02):
+    """ Convert a duration policy into seconds. 
 
+        duration: seconds (number or numeric string), 'match' to 
+            use the stimulus length, or 'psd:X' for the shortest 
+            noise whose Welch PSD estimate has a standard 
+            deviation of X dB per bin
+        num_samples: length of the stimulus
 
-    def mk_wgn(self, fs, dur):
-        """ Function to generate white Gaussian noise. """
-        if self.correlated:
-            print(f"noisemodel: Using correlated noise")
-            random.seed(4)
+        The result is never shorter than one Welch segment or 
+        the onset/offset ramps.
+    """
+    if isinstance(duration, str):
+        duration = duration.strip().lower()
+        if duration == 'match':
+            duration = num_samples / fs
+        elif duration.startswith('psd:'):
+            std_db = float(duration[4:])
+            # Relative standard deviation of an averaged periodogram 
+            # is 1/sqrt(K); 50% overlap Hann segments are slightly 
+            # correlated (~5.6% fewer effective averages)
+            num_segments = np.ceil((10*np.log10(np.e) / std_db)**2 * 1.056)
+            duration = (num_segments + 1) * (nperseg // 2) / fs
         else:
-            print(f"noisemodel: Using uncorrelated noise")
-        
-        wgn = [random.gauss(0.0, 1.0) for i in range(fs*dur)]
-        wgn = self._doNormalize(wgn)
+            duration = float(duration)
+
+    return max(float(duration), nperseg / fs, 4 * rampdur)
+
+
+def noise_length(num_samples, fs, duration=30, nperseg=2048, 
+        loopable=False):
+    """ Length in samples of the noise shape_noise() creates 
+        (see resolve_duration()). Loopable noise is rounded up 
+        to a fast FFT length.
+    """
+    num_noise = int(round(fs * resolve_duration(duration, num_samples, 
+        fs, nperseg)))
+    if loopable:
+        num_noise = fftmodel.fast_len(num_noise)
+    return num_noise
+
+
+def preset_options(preset, fs=48000, num_samples=0, num_channels=1,
+        overrides=None):
+    """ Expand a preset into shape_noise() keyword arguments. 
+
+        preset: 'preview', 'standard', 'reference', or 'budget:X' 
+            to pick the most accurate preset whose estimated run 
+            time for the whole file is X seconds or less. If even 
+            the preview does not fit, its duration is shortened.
+        overrides: options set explicitly by the user (e.g., 
+            loopable, order). These win over the preset's values; 
+            entries that are None are ignored.
+
+        :returns: a dict of options, including the preset name
+    """
+    if not preset.startswith('budget:'):
+        options = dict(PRESETS[preset])
+        options['preset'] = preset
+        return _apply_overrides(options, overrides)
+
+    budget = float(preset[7:])
+    for name in ('reference', 'standard', 'preview'):
+        options = dict(PRESETS[name])
+        dur = resolve_duration(options['duration'], num_samples, fs, 
+            options['nperseg'])
+        cost = _estimate_cost(name, dur, fs, num_channels)
+        if cost <= budget:
+            break
+    else:
+        # Shorten the preview to fit the budget
+        dur = max(dur * budget / cost, 4 * 0.02)
+        options['duration'] = dur
+        cost = _estimate_cost(name, dur, fs, num_channels)
+    print(f"noisemodel: Budget of {budget} s: using '{name}' preset " +
+        f"(estimated {np.round(cost, 2)} s)")
+    options['preset'] = f"{name} ({preset})"
+    return _apply_overrides(options, overrides)
+
+
+def _apply_overrides(options, overrides):
+    """ Merge explicit user OVERRIDES into preset OPTIONS. """
+    overrides = {key: value for key, value in (overrides or {}).items()
+        if value is not None}
+    changed = {key: value for key, value in overrides.items() 
+        if options.get(key) != value}
+    if changed:
+        print(f"noisemodel: '{options['preset']}' preset with " +
+            ", ".join(f"{key}={value}" for key, value in changed.items()))
+    options.update(overrides)
+    return options
+
+
+def _estimate_cost(preset, dur, fs, num_channels):
+    """ Rough run time (seconds) of a preset. """
+    threads, _ = fftmodel.split_workers(num_channels)
+    samples = dur * fs * int(np.ceil(num_channels / threads))
+    return _PRESET_COST[preset] * samples * _seconds_per_sample()
+
+
+def _seconds_per_sample():
+    """ Time one 'standard' noise pipeline on this machine 
+        (once per process) and return seconds per output sample.
+    """
+    if 'rate' not in _calibration:
+        num_samples = 2**16
+        rng = np.random.default_rng(0)
+        start = time.perf_counter()
+        x = rng.standard_normal(num_samples)
+        x = fftmodel.convolve(rng.standard_normal(1025), x, method='oa')
+        fftmodel.welch(x, 48000, nperseg=2048)
+        _calibration['rate'] = (time.perf_counter() - start) / num_samples
+    return _calibration['rate']
+
+
+def mk_wgn(fs, dur, correlated=False, seed=None):
+    """ Function to generate white Gaussian noise. Correlated 
+        noise always uses CORRELATED_SEED and comes from the 
+        shared noise provider as a read-only array.
+    """
+    if correlated:
+        print(f"noisemodel: Using correlated noise")
+        return noise_provider.get(fs, dur, CORRELATED_SEED)
+
+    print(f"noisemodel: Using uncorrelated noise")
+    return _generate_wgn(fs, dur, seed)
+
+
+def _generate_wgn(fs, dur, seed):
+    """ Generate normalized white Gaussian noise. """
+    rng = np.random.default_rng(seed)
+    # Vectorized generation (releases the GIL, unlike a
+    # per-sample random.gauss loop)
+    wgn = rng.standard_normal(int(round(fs*dur)))
+    wgn = _doNormalize(wgn)
+
+    return wgn
+
+
+class NoiseProvider:
+    """ Generate each white noise realization once per 
+        (fs, duration, seed) and hand out read-only views of it.
+
+        cache_dir: optional directory where realizations are 
+            stored as .npy files and memory-mapped, so later runs 
+            and worker processes share them without regenerating 
+            or copying
+        max_items: number of realizations kept in memory
+    """
+    def __init__(self, cache_dir=None, max_items=4):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, fs, dur, seed):
+        """ Return a read-only realization. """
+        key = (int(fs), int(round(fs*dur)), seed)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+            # Make room first, so no more than MAX_ITEMS are held 
+            # while the new realization is created
+            while self._cache and len(self._cache) >= self.max_items:
+                self._cache.popitem(last=False)
+
+            wgn = self._load_or_generate(fs, dur, seed)
+            wgn = wgn.view()
+            wgn.flags.writeable = False
+            if self.max_items > 0:
+                self._cache[key] = wgn
 
         return wgn
 
 
-    ####################
-    # Filter Functions #
-    ####################
-    def _create_filter(self):
-        """ Create even-numbered offset to remove 
-            extra points added by convolution
-            (directly related to the number of
-            taps - 1)
-        """
-        print(f"noisemodel: Creating filter")
-        # Set number of filter taps
-        num_taps = self._filter_taps() # Must be odd
-        offset = num_taps - 1
-
-        # # Find delay introduced by filter
-        # filt_delay = self._filter_delay(num_taps, self.fs)
-        # print(f"Filter delay (s): {filt_delay}")
-
-        # Create the filter
-        fir_filt = signal.firwin2(
-            numtaps=num_taps, 
-            freq=self.f_stim/np.max(self.f_stim), 
-            gain=np.sqrt(self.den_stim))
-
-        # FIR frequency response
-        w, h = signal.freqz(fir_filt)
-        w = w * self.fs / (2*np.pi)
-
-        # Call function to apply filter
-        self._apply_filter(fir_filt, offset)
-
-
-    def _apply_filter(self, filter, offset):
-        """ Convolve noise with filter. """
-        print("noisemodel: Applying filter to noise")
-        # Apply FIR to noise
-        filtered_noise = np.convolve(filter, self.noise)
-        # Normalize filtered noise
-        filtered_noise = filtered_noise / np.max(np.abs(filtered_noise))
-        # Remove the extra values added during convolution from beginning/end
-        filtered_noise = filtered_noise[:-offset]
-        # P Welch of filtered noise
-        f_filt_noise, den_filt_noise = signal.welch(
-            filtered_noise, self.fs, nperseg=2048)
+    def clear(self):
+        """ Drop all in-memory realizations. """
+        with self._lock:
+            self._cache.clear()
 
-        # Equalize RMS
-        self._correct_amplitude(filtered_noise)
-
-
-    def _correct_amplitude(self, filtered_noise):
-        """ Set the RMS of the noise to the RMS of the signal. """
-        print("noisemodel: Matching amplitudes")
-        # Get RMS of audio
-        rms_stim = self._rms(self.audio)
-        # Apply gating to filtered noise
-        filtered_noise = self._doGate(sig=filtered_noise,
-            rampdur=0.02,fs=self.fs)
-        # Normalize gated filtered noise
-        filtered_noise = self._doNormalize(filtered_noise)
-        # Get RMS of gated and normalized filtered noise
-        rms_filt_noise = self._rms(filtered_noise)
-        # Get difference in RMS between signal and noise
-        amp_diff =  rms_stim / rms_filt_noise
-        print(f"noisemodel: RMS of stimulus: {np.round(rms_stim, 5)}")
-        # Apply RMS offset to noise to equate RMS levels
-        self.adj_filtered_noise = filtered_noise * amp_diff
-        # Find PSD of final noise
-        self.f_adj_filt_noise, self.den_adj_filt_noise = signal.welch(
-            self.adj_filtered_noise, self.fs, nperseg=2048)
-        print(f"noisemodel: RMS of adjusted filtered noise: " +
-            f"{np.round(self._rms(self.adj_filtered_noise), 5)}")
-
-
-    ###################################
-    # Noise Shaping Support Functions #
-    ###################################
-    @staticmethod
-    def _filter_delay(num_taps, fs):
-        """ Calculate filter delay. """
-        filt_delay = (num_taps - 1) / (2 * fs)
-        return filt_delay
-
-
-    @staticmethod
-    def _filter_taps(d1=10**-4, d2=10**-3, Df=1000):
-        """ Determine number of filter taps. Based on:
-            https://dsp.stackexchange.com/questions/31066/how-many-taps-does-an-fir-filter-need
+
+    def _load_or_generate(self, fs, dur, seed):
+        """ Memory-map a persisted realization, or create one. """
+        if not self.cache_dir:
+            return _generate_wgn(fs, dur, seed)
+
+        file_path = os.path.join(self.cache_dir, 
+            f"wgn_{int(fs)}_{int(round(fs*dur))}_{seed}.npy")
+        if not os.access(file_path, os.F_OK):
+            print(f"noisemodel: Writing noise cache {file_path}")
+            os.makedirs(self.cache_dir, exist_ok=True)
+            wgn = _generate_wgn(fs, dur, seed)
+            # Write to a temporary file first so concurrent 
+            # processes never read a partial file
+            fd, temp_path = tempfile.mkstemp(suffix='.npy', 
+                dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, wgn)
+            os.replace(temp_path, file_path)
+
+        return np.load(file_path, mmap_mode='r')
+
+
+# Shared provider used by mk_wgn()
+noise_provider = NoiseProvider()
+
+
+def set_noise_cache(cache_dir):
+    """ Persist correlated noise realizations in CACHE_DIR 
+        (None keeps them in memory only).
+    """
+    noise_provider.cache_dir = cache_dir
+    noise_provider.clear()
+
+
+####################
+# Filter Functions #
+####################
+class ShapingFilter:
+    """ A designed shaping filter. 
+
+        engine: 'fir' (COEFFS are taps), 'iir' (COEFFS are 
+            second-order sections) or 'spectral' (COEFFS are 
+            frequencies normalized to Nyquist and zero-phase 
+            magnitudes for frequency-domain synthesis)
+        error: spectral-match error (dB) against the stimulus PSD
+        order: IIR model order (odd orders are padded to whole 
+            second-order sections)
+    """
+    __slots__ = ('engine', 'coeffs', 'error', 'order')
+
+    def __init__(self, engine, coeffs, error=None, order=None):
+        self.engine = engine
+        self.coeffs = coeffs
+        self.error = error
+        self.order = order
+
+
+    @property
+    def size(self):
+        """ Number of taps (FIR), filter order (IIR) or 
+            frequency points (spectral).
         """
-        num_taps = int((2/3)*np.log10(1/(10*d1*d2))*Df)
-        if not num_taps % 2:
-            num_taps += 1
-
-        return num_taps
-
-
-    @staticmethod
-    def _doNormalize(sig):
-        """ Remove DC offset and normalize by max value. """
-        # remove DC offset
-        sig = sig - np.mean(sig)
-        # normalize
-        sig = sig / np.max(abs(sig))
-
-        return sig
-
-
-    @staticmethod
-    def _check_for_clipping(adj_filtered_noise):
-        """ Check for clipping in the final noise. """
-        max_amp = np.max(abs(adj_filtered_noise))
-        if max_amp > 1:
-            print("noisemodel: Clipping has occurred!\n" +
-                  "Calibration file not created!")
-            messagebox.showerror(
-                title="Clipping!",
-                message="There is clipping in the output file!",
-                detail="If the original audio file is near the +1/-1 " +
-                    "limits, some noise fluctuations will exceed these  " +
-                    "boundaries and cause clipping\n" +
-                    "Aborting."
-            )
-            sys.exit()
+        if self.engine == 'iir':
+            return self.order or 2 * len(self.coeffs)
+        if self.engine == 'spectral':
+            return len(self.coeffs[0])
+        return len(self.coeffs)
+
+
+    def response(self, f, fs):
+        """ Complex frequency response at frequencies F (Hz). """
+        if self.engine == 'iir':
+            _, h = signal.sosfreqz(self.coeffs, worN=f, fs=fs)
+        elif self.engine == 'spectral':
+            h = np.interp(f, self.coeffs[0] * fs / 2, self.coeffs[1])
         else:
-            print("No clipping! File OK!")
+            _, h = signal.freqz(self.coeffs, worN=f, fs=fs)
+        return h
 
 
-    @staticmethod
-    def _db2mag(db):
-        """ Convert decibels to magnitude. Takes a single
-            value or a list of values.
+    def apply(self, noise, method='fft'):
+        """ Filter NOISE and normalize by max value. The output 
+            has the same length as NOISE. METHOD is the FIR 
+            convolution method (see fftmodel.convolve()).
         """
-        # Must use this form to handle negative db values!
-        try:
-            mag = [10**(x/20) for x in db]
-            return mag
-        except:
-            mag = 10**(db/20)
-            return mag
-
-
-    @staticmethod
-    def _mag2db(mag):
-        """ Convert magnitude to decibels. Takes a single
-            value or a list of values.
-        """
-        try:
-            db = [20 * np.log10(x) for x in mag]
-            return db
-        except:
-            db = 20 * np.log10(mag)
-            return db
-
-
-    @staticmethod
-    def _doGate(sig, rampdur=0.02, fs=48000):
-        """ Apply rising and falling ramps to signal SIG, of 
-            duration RAMPDUR. Takes a 1-channel or 2-channel 
-            signal. 
-
-                SIG: a 1-channel or 2-channel signal
-                RAMPDUR: duration of one side of the gate in 
-                    seconds
-                FS: sampling rate in samples/second
-
-                Example: 
-                [t, tone] = mkTone(100,0.4,0,48000)
-                gated = _doGate(tone,0.01,48000)
-
-            Original code: Anonymous
-            Adapted by: Travis M. Moore
-            Last edited: Jan. 13, 2022          
+        if self.engine == 'iir':
+            print("noisemodel: Applying IIR filter to noise")
+            filtered_noise = signal.sosfilt(self.coeffs, noise)
+            return filtered_noise / np.max(np.abs(filtered_noise))
+        if self.engine == 'spectral':
+            # Frequency-domain synthesis is inherently circular 
+            # (fs=2 puts Nyquist at the normalized frequency 1)
+            return self.apply_circular(noise, fs=2)
+        return _apply_filter(self.coeffs, noise, len(self.coeffs) - 1, 
+            method)
+
+
+    def apply_circular(self, noise, fs):
+        """ Filter NOISE circularly with a single rFFT multiply 
+            and normalize by max value. The output wraps around, 
+            so it can be looped without discontinuities.
         """
-        gate =  np.cos(np.linspace(np.pi, 2*np.pi, int(fs*rampdur)))
-        # Adjust envelope modulator to be within +/-1
-        gate = gate + 1 # translate modulator values to the 0/+2 range
-        gate = gate/2 # compress values within 0/+1 range
-        # Create offset gate by flipping the array
-        offsetgate = np.flip(gate)
-        # Check number of channels in signal
-        if len(sig.shape) == 1:
-            # Create "sustain" portion of envelope
-            sustain = np.ones(len(sig)-(2*len(gate)))
-            envelope = np.concatenate([gate, sustain, offsetgate])
-            gated = envelope * sig
-        elif len(sig.shape) == 2:
-            # Create "sustain" portion of envelope
-            sustain = np.ones(len(sig[0])-(2*len(gate)))
-            envelope = np.concatenate([gate, sustain, offsetgate])
-            gatedLeft = envelope * sig[0]
-            gatedRight = envelope * sig[1]
-            gated = np.array([gatedLeft, gatedRight])
-        return gated
-
-
-    @staticmethod
-    def _rms(sig):
-        """ Calculate the root mean square of a signal. 
-            
-            NOTE: np.square will return invalid, negative 
-                results if the number excedes the bit 
-                depth. In these cases, convert to int64
-                EXAMPLE: sig = np.array(sig,dtype=int)
-
-            Written by: Travis M. Moore
-            Last edited: Feb. 3, 2020
+        print("noisemodel: Applying circular filter to noise")
+        n = len(noise)
+        if self.engine == 'fir':
+            taps = self.coeffs
+            if len(taps) > n:
+                # Time-alias taps longer than the buffer (rfft would 
+                # truncate them); circular convolution is the same
+                taps = np.pad(taps, (0, -len(taps) % n)).reshape(
+                    -1, n).sum(axis=0)
+            h = sp_fft.rfft(taps, n)
+        else:
+            h = self.response(sp_fft.rfftfreq(n, 1/fs), fs)
+        filtered_noise = sp_fft.irfft(sp_fft.rfft(noise) * h, n)
+        return filtered_noise / np.max(np.abs(filtered_noise))
+
+
+def _create_filter(noise, f_stim, den_stim, fs, circular=False, 
+        method='fft', **kwargs):
+    """ Design a shaping filter (see design_filter()) and pass 
+        the noise through it (circularly if CIRCULAR).
+
+        :returns: filtered noise and a dict with the engine, 
+            filter size and the achieved spectral-match error (dB)
+    """
+    filt = design_filter(f_stim, den_stim, fs, **kwargs)
+
+    # Call function to apply filter
+    if circular:
+        filtered_noise = filt.apply_circular(noise, fs)
+    else:
+        filtered_noise = filt.apply(noise, method)
+    if filt.engine == 'spectral':
+        filt.error = _synthesis_error(filt, len(noise), f_stim, den_stim)
+    size_key = {'fir': 'num_taps', 'iir': 'order', 'spectral': 'bins'}
+    info = {
+        'engine': filt.engine,
+        size_key[filt.engine]: filt.size,
+        'match_error_db': filt.error
+    }
+    return filtered_noise, info
+
+
+def design_filter(f_stim, den_stim, fs, engine='fir', tolerance=None, 
+        smoothing=None, order=None):
+    """ Design a filter that follows the stimulus PSD.
+
+        engine: 'fir' for a linear-phase FIR (firwin2), 'iir' 
+            for a low-order all-pole (LPC/Yule-Walker) model in 
+            second-order sections, or 'spectral' for frequency-
+            domain synthesis (the noise spectrum is multiplied by 
+            the interpolated PSD magnitude; always circular)
+        tolerance: spectral-match tolerance in dB. If given, use 
+            the smallest filter that meets it.
+        smoothing: smooth the PSD to 1/SMOOTHING octave before 
+            designing the filter
+        order: IIR model order (default: 24, or the lowest 
+            order meeting TOLERANCE)
+
+        :returns: a ShapingFilter
+    """
+    print(f"noisemodel: Creating {engine.upper()} filter")
+    # Optionally smooth the target spectrum
+    den_design = den_stim
+    if smoothing:
+        den_design = _smooth_psd(f_stim, den_stim, smoothing)
+
+    if engine == 'iir':
+        filt = _select_iir(f_stim, den_stim, den_design, fs, tolerance, 
+            order)
+        print(f"noisemodel: Using order {filt.size} " +
+            f"(spectral error: {np.round(filt.error, 2)} dB)")
+    elif engine == 'fir':
+        # Set number of filter taps (must be odd) and create the filter
+        if tolerance:
+            fir_filt, error = _adaptive_fir(f_stim, den_stim, den_design, 
+                fs, tolerance)
+        else:
+            fir_filt = _design_fir(f_stim, den_design, _filter_taps())
+            error = _fir_error(fir_filt, f_stim, den_stim, fs)
+        filt = ShapingFilter('fir', fir_filt, error)
+        print(f"noisemodel: Using {filt.size} taps " +
+            f"(spectral error: {np.round(error, 2)} dB)")
+    elif engine == 'spectral':
+        # Zero-phase magnitude, interpolated onto the noise spectrum
+        # (the error depends on the noise length; see 
+        # _synthesis_error())
+        filt = ShapingFilter('spectral', 
+            (f_stim/np.max(f_stim), np.sqrt(den_design)))
+    else:
+        raise ValueError(f"Unknown filter engine: {engine}")
+
+    return filt
+
+
+def _design_fir(f_stim, den_stim, num_taps):
+    """ Design a linear-phase FIR following the PSD. """
+    return signal.firwin2(
+        numtaps=num_taps, 
+        freq=f_stim/np.max(f_stim), 
+        gain=np.sqrt(den_stim))
+
+
+def _adaptive_fir(f_stim, den_stim, den_design, fs, tolerance, 
+        min_taps=33):
+    """ Find the shortest FIR whose power response is within 
+        TOLERANCE dB (RMS) of DEN_STIM. Doubles the length until 
+        the tolerance is met, then bisects. Falls back to the 
+        fixed _filter_taps() length.
+
+        :returns: the FIR and its spectral-match error
+    """
+    max_taps = _filter_taps()
+
+    # Grow until the tolerance is met
+    lo = None
+    num_taps = min_taps
+    while True:
+        fir_filt = _design_fir(f_stim, den_design, num_taps)
+        error = _fir_error(fir_filt, f_stim, den_stim, fs)
+        if error <= tolerance or num_taps >= max_taps:
+            break
+        lo = num_taps
+        num_taps = min(2*num_taps - 1, max_taps)
+    if error > tolerance:
+        print(f"noisemodel: Tolerance of {tolerance} dB not met " +
+            f"with {max_taps} taps")
+        return fir_filt, error
+
+    # Bisect between the last failing and first passing lengths
+    hi = num_taps
+    while lo is not None and hi - lo > max(2, hi // 8):
+        mid = (lo + hi) // 2
+        mid += 1 - mid % 2 # Keep odd
+        candidate = _design_fir(f_stim, den_design, mid)
+        candidate_error = _fir_error(candidate, f_stim, den_stim, fs)
+        if candidate_error <= tolerance:
+            hi, fir_filt, error = mid, candidate, candidate_error
+        else:
+            lo = mid
+
+    return fir_filt, error
+
+
+def _design_iir(den_stim, order):
+    """ Fit an all-pole model to the PSD: the autocorrelation is 
+        the inverse FFT of the PSD, and the Yule-Walker equations 
+        are solved with Levinson recursion. The autocorrelation 
+        method always gives a stable filter.
+
+        :returns: second-order sections
+    """
+    r = np.fft.irfft(den_stim)
+    # Tiny white-noise correction keeps the system well conditioned
+    r[0] *= 1 + 1e-9
+    a = linalg.solve_toeplitz(r[:order], r[1:order+1])
+    gain = np.sqrt(max(r[0] - np.dot(a, r[1:order+1]), 1e-300))
+    return signal.tf2sos([gain], np.concatenate([[1.0], -a]))
+
+
+def _select_iir(f_stim, den_stim, den_design, fs, tolerance=None, 
+        order=None, orders=(2, 4, 6, 8, 12, 16, 24, 32, 48, 64)):
+    """ Design an IIR of the given ORDER, or the lowest order 
+        from ORDERS meeting TOLERANCE.
+    """
+    if order or not tolerance:
+        orders = (order or 24,)
+    for order in orders:
+        sos = _design_iir(den_design, order)
+        filt = ShapingFilter('iir', sos, order=order)
+        filt.error = _spectral_error(den_stim, 
+            np.abs(filt.response(f_stim, fs))**2)
+        if tolerance and filt.error <= tolerance:
+            break
+    else:
+        if tolerance:
+            print(f"noisemodel: Tolerance of {tolerance} dB not met " +
+                f"with order {order}")
+
+    return filt
+
+
+def _fir_error(fir_filt, f_stim, den_stim, fs):
+    """ Spectral-match error (dB) of an FIR against a PSD. """
+    _, h = signal.freqz(fir_filt, worN=f_stim, fs=fs)
+    return _spectral_error(den_stim, np.abs(h)**2)
+
+
+def _synthesis_error(filt, num_samples, f_stim, den_stim):
+    """ Spectral-match error (dB) of frequency-domain synthesis 
+        of NUM_SAMPLES: the interpolated power response on the 
+        noise FFT grid, averaged over each stimulus bin as a 
+        Welch estimate at the stimulus resolution would see it.
+    """
+    freq, magnitude = filt.coeffs
+    grid = sp_fft.rfftfreq(num_samples, 1/2)
+    power = np.interp(grid, freq, magnitude)**2
+
+    # Noise bins closest to each stimulus bin
+    edges = (freq[1:] + freq[:-1]) / 2
+    index = np.searchsorted(edges, grid)
+    counts = np.bincount(index, minlength=len(freq))
+    den_noise = np.bincount(index, power, minlength=len(freq))
+    # Stimulus bins finer than the noise grid: response at the bin
+    empty = counts == 0
+    den_noise[empty] = magnitude[empty]**2
+    den_noise[~empty] /= counts[~empty]
+    return _spectral_error(den_stim, den_noise)
+
+
+def _spectral_error(den_target, den_actual, dynamic_range=60):
+    """ RMS difference in dB between two spectra. The overall 
+        level offset is removed (it is corrected by RMS matching) 
+        and only bins within DYNAMIC_RANGE dB of the target peak 
+        are compared.
+    """
+    floor = np.max(den_target) * 10**(-dynamic_range/10)
+    mask = den_target > floor
+    diff = 10*np.log10(np.maximum(den_actual[mask], 1e-300) / 
+        den_target[mask])
+    diff = diff - np.mean(diff)
+    return float(np.sqrt(np.mean(np.square(diff))))
+
+
+def _smooth_psd(f, den, fraction):
+    """ Smooth a PSD by averaging power over a 1/FRACTION 
+        octave band centred on each bin.
+    """
+    csum = np.concatenate([[0], np.cumsum(den)])
+    lo = np.searchsorted(f, f * 2**(-1/(2*fraction)), side='left')
+    hi = np.searchsorted(f, f * 2**(1/(2*fraction)), side='right')
+    hi = np.maximum(hi, lo + 1)
+    return (csum[hi] - csum[lo]) / (hi - lo)
+
+
+def _apply_filter(filter, noise, offset, method='fft'):
+    """ Convolve noise with filter. """
+    print("noisemodel: Applying filter to noise")
+    # Apply FIR to noise (same result as np.convolve)
+    filtered_noise = fftmodel.convolve(filter, noise, method=method)
+    # Normalize filtered noise
+    filtered_noise = filtered_noise / np.max(np.abs(filtered_noise))
+    # Remove the extra values added during convolution from beginning/end
+    filtered_noise = filtered_noise[:-offset]
+
+    return filtered_noise
+
+
+def _correct_amplitude(filtered_noise, rms_stim, fs, gate=True):
+    """ Set the RMS of the noise to the RMS of the signal. """
+    print("noisemodel: Matching amplitudes")
+    # Apply gating to filtered noise
+    if gate:
+        filtered_noise = _doGate(sig=filtered_noise, rampdur=0.02, fs=fs)
+    # Normalize gated filtered noise
+    filtered_noise = _doNormalize(filtered_noise)
+    # Get RMS of gated and normalized filtered noise
+    rms_filt_noise = _rms(filtered_noise)
+    # Get difference in RMS between signal and noise
+    amp_diff =  rms_stim / rms_filt_noise
+    print(f"noisemodel: RMS of stimulus: {np.round(rms_stim, 5)}")
+    # Apply RMS offset to noise to equate RMS levels
+    adj_filtered_noise = filtered_noise * amp_diff
+    print(f"noisemodel: RMS of adjusted filtered noise: " +
+        f"{np.round(_rms(adj_filtered_noise), 5)}")
+
+    return adj_filtered_noise
+
+
+###################################
+# Noise Shaping Support Functions #
+###################################
+def _filter_delay(num_taps, fs):
+    """ Calculate filter delay. """
+    filt_delay = (num_taps - 1) / (2 * fs)
+    return filt_delay
+
+
+def _filter_taps(d1=10**-4, d2=10**-3, Df=1000):
+    """ Determine number of filter taps. Based on:
+        https://dsp.stackexchange.com/questions/31066/how-many-taps-does-an-fir-filter-need
+    """
+    num_taps = int((2/3)*np.log10(1/(10*d1*d2))*Df)
+    if not num_taps % 2:
+        num_taps += 1
+
+    return num_taps
+
+
+def _doNormalize(sig):
+    """ Remove DC offset and normalize by max value. """
+    # remove DC offset
+    sig = sig - np.mean(sig)
+    # normalize
+    sig = sig / np.max(abs(sig))
+
+    return sig
+
+
+def _check_for_clipping(adj_filtered_noise):
+    """ Check for clipping in the final noise. """
+    max_amp = np.max(abs(adj_filtered_noise))
+    if max_amp > 1:
+        print("noisemodel: Clipping has occurred!\n" +
+              "Calibration file not created!")
+        messagebox.showerror(
+            title="Clipping!",
+            message="There is clipping in the output file!",
+            detail="If the original audio file is near the +1/-1 " +
+                "limits, some noise fluctuations will exceed these  " +
+                "boundaries and cause clipping\n" +
+                "Aborting."
+        )
+        sys.exit()
+    else:
+        print("No clipping! File OK!")
+
+
+def _db2mag(db):
+    """ Convert decibels to magnitude. Takes a single
+        value or a list of values.
+    """
+    # Must use this form to handle negative db values!
+    try:
+        mag = [10**(x/20) for x in db]
+        return mag
+    except:
+        mag = 10**(db/20)
+        return mag
+
+
+def _mag2db(mag):
+    """ Convert magnitude to decibels. Takes a single
+        value or a list of values.
+    """
+    try:
+        db = [20 * np.log10(x) for x in mag]
+        return db
+    except:
+        db = 20 * np.log10(mag)
+        return db
+
+
+def _doGate(sig, rampdur=0.02, fs=48000):
+    """ Apply rising and falling ramps to signal SIG, of 
+        duration RAMPDUR. Takes a 1-channel or 2-channel 
+        signal. 
+
+            SIG: a 1-channel or 2-channel signal
+            RAMPDUR: duration of one side of the gate in 
+                seconds
+            FS: sampling rate in samples/second
+
+            Example: 
+            [t, tone] = mkTone(100,0.4,0,48000)
+            gated = _doGate(tone,0.01,48000)
+
+        Original code: Anonymous
+        Adapted by: Travis M. Moore
+        Last edited: Jan. 13, 2022          
+    """
+    gate =  np.cos(np.linspace(np.pi, 2*np.pi, int(fs*rampdur)))
+    # Adjust envelope modulator to be within +/-1
+    gate = gate + 1 # translate modulator values to the 0/+2 range
+    gate = gate/2 # compress values within 0/+1 range
+    # Create offset gate by flipping the array
+    offsetgate = np.flip(gate)
+    # Check number of channels in signal
+    if len(sig.shape) == 1:
+        # Create "sustain" portion of envelope
+        sustain = np.ones(len(sig)-(2*len(gate)))
+        envelope = np.concatenate([gate, sustain, offsetgate])
+        gated = envelope * sig
+    elif len(sig.shape) == 2:
+        # Create "sustain" portion of envelope
+        sustain = np.ones(len(sig[0])-(2*len(gate)))
+        envelope = np.concatenate([gate, sustain, offsetgate])
+        gatedLeft = envelope * sig[0]
+        gatedRight = envelope * sig[1]
+        gated = np.array([gatedLeft, gatedRight])
+    return gated
+
+
+def _rms(sig):
+    """ Calculate the root mean square of a signal. 
+
+        NOTE: np.square will return invalid, negative 
+            results if the number excedes the bit 
+            depth. In these cases, convert to int64
+            EXAMPLE: sig = np.array(sig,dtype=int)
+
+        Written by: Travis M. Moore
+        Last edited: Feb. 3, 2020
+    """
+    theRMS = np.sqrt(np.mean(np.square(sig)))
+    return theRMS
+
+
+##################
+# Legacy Wrapper #
+##################
+class NoiseShaper:
+    """ Create filtered noise based on the power spectral
+        density of a given audio signal.
+
+        Thin wrapper around shape_noise(). Only the last 
+        ShapedNoise result is kept; use shape_noise() directly 
+        to share one code path between threads.
+    """
+    CORRELATED_SEED = CORRELATED_SEED
+
+    def __init__(self):
+        self.result = None
+
+
+    def shape_noise(self, audio, fs, correlated, **kwargs):
+        """ See module-level shape_noise().
+
+            :returns: a filtered white Gaussian noise
         """
-        theRMS = np.sqrt(np.mean(np.square(sig)))
-        return theRMS
+        self.result = shape_noise(audio, fs, correlated, **kwargs)
+        return self.result.noise
+
+
+    # Read-only views of the last result for existing callers
+    @property
+    def adj_filtered_noise(self):
+        return self.result.noise
+
+    @property
+    def f_stim(self):
+        return self.result.f_stim
+
+    @property
+    def den_stim(self):
+        return self.result.den_stim
+
+    @property
+    def f_adj_filt_noise(self):
+        return self.result.f_noise
+
+    @property
+    def den_adj_filt_noise(self):
+        return self.result.den_noise
+
+
+    # Support functions
+    mk_wgn = staticmethod(mk_wgn)
+    _filter_delay = staticmethod(_filter_delay)
+    _filter_taps = staticmethod(_filter_taps)
+    _doNormalize = staticmethod(_doNormalize)
+    _check_for_clipping = staticmethod(_check_for_clipping)
+    _db2mag = staticmethod(_db2mag)
+    _mag2db = staticmethod(_mag2db)
+    _doGate = staticmethod(_doGate)
+    _rms = staticmethod(_rms)
+
+
+###########################
+# Multichannel Processing #
+###########################
+def shape_channels(audio, fs, correlated, workers=None, seed=None, 
+        spectrum=None, threads=None, channel_major=False, **kwargs):
+    """ Shape every channel of AUDIO concurrently in a thread 
+        pool. The FFT and random number kernels release the GIL, 
+        so channels run in parallel without pickling any data.
+
+        audio: a 1-D (single channel) or (N, C) array, or a (C, N) 
+            array if CHANNEL_MAJOR (e.g., audiomodel.Audio.data). 
+            May be None if SPECTRUM is given.
+        workers: total thread budget (defaults to the global 
+            fftmodel configuration). Split between channel threads 
+            and scipy.fft workers within each channel.
+        seed: base seed for uncorrelated noise. Each channel gets 
+            its own child seed, so a given seed always produces 
+            the same per-channel noises regardless of worker count.
+        spectrum: precomputed multichannel Spectrum of the stimulus 
+            (e.g., from spectrummodel.estimate())
+        threads: most channels shaped at once (e.g., to bound 
+            memory; see plannermodel). The thread budget is still 
+            used in full by giving each channel more FFT workers.
+        kwargs: passed on to shape_noise()
+
+        :yields: (channel index, ShapedNoise) tuples in channel 
+            order. Callers that copy the noise elsewhere should set 
+            result.noise to None so it can be freed.
+    """
+    # Analyse every channel of the stimulus in one pass
+    if spectrum is None:
+        with fftmodel.fft_workers(workers):
+            spectrum = spectrummodel.analyse(audio, fs, 
+                nperseg=kwargs.get('nperseg', 2048), 
+                channel_major=channel_major)
+
+    # Get number of channels
+    num_channels = spectrum.num_channels
+    threads, fft_workers = fftmodel.split_workers(
+        min(num_channels, threads or num_channels), workers)
+
+    # Deterministic per-channel seeds
+    seeds = np.random.SeedSequence(seed).spawn(num_channels)
+
+    def _shape(ii):
+        return shape_noise(
+            audio=None,
+            spectrum=spectrum.channel(ii),
+            fs=fs,
+            correlated=correlated,
+            seed=seeds[ii],
+            workers=fft_workers,
+            **kwargs
+        )
+
+    print(f"noisemodel: Shaping {num_channels} channel(s) using " +
+        f"{threads} thread(s) x {fft_workers} FFT worker(s)")
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        # At most THREADS channels in flight, so finished noises are 
+        # not held here while earlier channels are consumed
+        pending = deque(pool.submit(_shape, ii) 
+            for ii in range(min(threads, num_channels)))
+        for ii in range(num_channels):
+            # Hand back results in channel order as they become 
+            # available; the next channel starts before the caller 
+            # takes this one
+            result = pending.popleft().result()
+            if ii + threads < num_channels:
+                pending.append(pool.submit(_shape, ii + threads))
+            yield ii, result
+            result = None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,270 @@
+""" Memory planner for shaping jobs. Estimates the peak memory of
+    each stage (read, analysis, noise, convolution, post-
+    processing, write) from the file header and shaping options,
+    and picks concurrency, block sizes and streaming or in-memory
+    paths that fit a memory budget.
+
+    Usage:
+        header = sf.info(path)
+        plan = plannermodel.plan_job(header.frames, header.channels,
+            header.samplerate, options, max_memory='4G')
+        print(plan.describe())
+"""
+
+###########
+# Imports #
+###########
+# Data Science
+import numpy as np
+
+# Custom
+from models import fftmodel
+from models import noisemodel
+
+
+#############
+# Constants #
+#############
+# Bytes per float64 sample
+_SAMPLE = 8
+
+# Peak working memory of each stage, in multiples of one channel
+# of noise (measured with tracemalloc on one 30 s channel)
+_NOISE_FACTOR = 3
+_CONVOLUTION_FACTOR = {'fft': 6, 'oa': 5.5, 'direct': 3, 'iir': 4,
+    'spectral': 4, 'circular': 4}
+_AMPLITUDE_FACTOR = 4
+_PSD_FACTOR = 5
+
+# Peak memory of an in-memory Welch analysis, in multiples of the
+# signal (channel-major copy plus segment and FFT buffers), and of
+# a blocked analysis in multiples of the block read
+_ANALYSIS_FACTOR = 5
+_BLOCK_FACTOR = 8
+
+# Block sizes are chosen so one block uses at most this share of
+# the budget
+_BLOCK_SHARE = 1 / 16
+
+_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+#########
+# BEGIN #
+#########
+class Plan:
+    """ Execution plan for one file.
+
+        threads: channels shaped at once
+        analysis: 'memory' (read the whole stimulus) or 'stream'
+            (blocked Welch analysis read from disk)
+        psd_segments: Welch segments per block for the output PSD
+            (None: in memory)
+        output: 'memory' or 'memmap' (output buffer on disk)
+        block_segments: Welch segments per block when streaming
+        write_block: frames converted per write block
+        stages: estimated peak bytes of each stage
+        peak: estimated peak bytes of the job
+        budget: memory budget in bytes (None: unlimited)
+    """
+    __slots__ = ('threads', 'analysis', 'psd_segments', 'output',
+        'block_segments', 'write_block', 'stages', 'peak', 'budget')
+
+    def __init__(self, threads, analysis='memory', psd_segments=None,
+            output='memory', block_segments=256, write_block=2**16):
+        self.threads = threads
+        self.analysis = analysis
+        self.psd_segments = psd_segments
+        self.output = output
+        self.block_segments = block_segments
+        self.write_block = write_block
+        self.stages = {}
+        self.peak = 0
+        self.budget = None
+
+
+    @property
+    def fits(self):
+        return self.budget is None or self.peak <= self.budget
+
+
+    def pending_writes(self, requested):
+        """ How many finished outputs may wait for the background 
+            writer (at most REQUESTED) within the budget. 
+        """
+        output = self.stages.get('output')
+        if self.budget is None or not output:
+            return requested
+        return int(min(requested, max(self.budget - self.peak, 0) // output))
+
+
+    def describe(self):
+        """ One line per stage, then the chosen paths. """
+        lines = [f"  {stage:<12}{format_size(size):>10}"
+            for stage, size in self.stages.items()]
+        lines.append(f"  {'peak':<12}{format_size(self.peak):>10}" +
+            (f" of {format_size(self.budget)}" if self.budget else ""))
+        lines.append(f"  {self.threads} channel(s) at once, " +
+            f"{self.analysis} analysis, {self.output} output, " +
+            f"{'blocked' if self.psd_segments else 'in-memory'} " +
+            "output PSD")
+        return '\n'.join(lines)
+
+
+def parse_size(size):
+    """ Convert '512M', '4G', '1.5G' or a number of bytes to
+        bytes.
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    size = size.strip().upper().rstrip('B')
+    unit = size[-1] if size and size[-1] in _UNITS else ''
+    return int(float(size[:len(size) - len(unit)]) * _UNITS[unit])
+
+
+def format_size(num_bytes):
+    """ Bytes as a short human-readable string. """
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == 'B' \
+                else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+
+def estimate(plan, num_samples, num_channels, fs, options, 
+        processes=None):
+    """ Fill PLAN.stages and PLAN.peak for a stimulus of
+        NUM_SAMPLES x NUM_CHANNELS and the shape_noise() OPTIONS.
+
+        processes: worker processes shaping channels (None: 
+            threads). Each process holds its own correlated noise.
+    """
+    nperseg = options.get('nperseg', 2048)
+    noise_len = _noise_length(num_samples, fs, options)
+    noise = noise_len * _SAMPLE
+    stimulus = num_samples * num_channels * _SAMPLE
+    output = noise * num_channels
+
+    # Stimulus read and analysis
+    if plan.analysis == 'memory':
+        read = stimulus
+        analysis = _ANALYSIS_FACTOR * stimulus
+    else:
+        block = _analysis_block(plan.block_segments, nperseg, num_channels)
+        read = block
+        analysis = _BLOCK_FACTOR * block
+
+    # Per-channel shaping stages
+    engine = options.get('engine', 'fir')
+    if options.get('loopable'):
+        key = 'circular'
+    elif engine == 'fir':
+        key = options.get('method', 'fft')
+    else:
+        key = engine
+    noise_stage = _NOISE_FACTOR * noise
+    convolution = _CONVOLUTION_FACTOR[key] * noise
+    if plan.psd_segments:
+        psd = noise + _BLOCK_FACTOR * _analysis_block(plan.psd_segments, 
+            nperseg, 1)
+    else:
+        psd = _PSD_FACTOR * noise
+    post = max(_AMPLITUDE_FACTOR * noise, psd)
+
+    # Each running channel holds its peak stage; one finished 
+    # result waits to be copied into the output (shape_channels() 
+    # keeps no more than THREADS channels in flight)
+    per_channel = max(noise_stage, convolution, post)
+    # One correlated realization per process (the noise provider 
+    # is limited to one under a budget; see plan_job())
+    shared = 0
+    if options.get('correlated', True):
+        shared = noise * (min(processes, plan.threads) if processes else 1)
+    resident_output = output if plan.output == 'memory' else 0
+    write = plan.write_block * num_channels * _SAMPLE * 3
+
+    plan.stages = {
+        'read': read,
+        'analysis': analysis,
+        'noise': noise_stage,
+        'convolution': convolution,
+        'post': post,
+        'output': resident_output,
+        'write': write
+    }
+    plan.peak = max(
+        read + analysis,
+        resident_output + shared + plan.threads * per_channel + noise,
+        resident_output + write
+    )
+    return plan
+
+
+def plan_job(num_samples, num_channels, fs, options, max_memory=None,
+        workers=None, processes=None):
+    """ Choose how to run a job within MAX_MEMORY bytes (or a
+        size string such as '4G'). Cheapest changes come first:
+        blocked output PSD, streamed analysis, on-disk output
+        buffer, then fewer channels at once.
+
+        options: shape_noise() options (plus 'correlated')
+        workers: thread budget (defaults to the global fftmodel
+            configuration)
+        processes: worker processes shaping channels, if any
+
+        The estimate counts one correlated noise realization per 
+        process: set noisemodel.noise_provider.max_items to 1 
+        when running within MAX_MEMORY.
+
+        :returns: a Plan. Plan.fits is False if the job cannot
+            fit even with every saving applied.
+    """
+    threads, _ = fftmodel.split_workers(num_channels, workers)
+    plan = Plan(threads)
+    if max_memory is None:
+        return estimate(plan, num_samples, num_channels, fs, options, 
+            processes)
+    budget = parse_size(max_memory)
+    plan.budget = budget
+
+    # Block sizes: one block within a fixed share of the budget
+    nperseg = options.get('nperseg', 2048)
+    plan.block_segments = int(np.clip(budget * _BLOCK_SHARE
+        // (_BLOCK_FACTOR * _analysis_block(1, nperseg, num_channels)),
+        16, 1024))
+    plan.write_block = int(np.clip(budget * _BLOCK_SHARE
+        // (num_channels * _SAMPLE * 3), 2**12, 2**18))
+
+    steps = (
+        lambda: setattr(plan, 'psd_segments', plan.block_segments),
+        lambda: setattr(plan, 'analysis', 'stream'),
+        lambda: setattr(plan, 'output', 'memmap'),
+    )
+    estimate(plan, num_samples, num_channels, fs, options, processes)
+    for step in steps:
+        if plan.fits:
+            break
+        step()
+        estimate(plan, num_samples, num_channels, fs, options, processes)
+
+    # Fewer channels at once
+    while not plan.fits and plan.threads > 1:
+        plan.threads -= 1
+        estimate(plan, num_samples, num_channels, fs, options, processes)
+
+    return plan
+
+
+def _noise_length(num_samples, fs, options):
+    """ Calibration noise length in samples for shape_noise() 
+        OPTIONS.
+    """
+    return noisemodel.noise_length(num_samples, fs, 
+        options.get('duration', 30), options.get('nperseg', 2048), 
+        options.get('loopable', False))
+
+
+def _analysis_block(block_segments, nperseg, num_channels):
+    """ Bytes of one block of Welch segments (50% overlap). """
+    return (block_segments + 1) * (nperseg // 2) * num_channels * _SAMPLE
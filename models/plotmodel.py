@@ -0,0 +1,79 @@
+""" Plotting data layer: bins power spectral densities onto a
+    log-frequency grid with min/max envelopes and caches the
+    dB-converted results per channel, so redraws stay cheap at
+    any resolution and channel count.
+"""
+
+###########
+# Imports #
+###########
+# Data Science
+import numpy as np
+
+
+#########
+# BEGIN #
+#########
+class BinnedSpectrum:
+    """ PSD binned onto a fractional-octave grid (levels in dB). """
+    __slots__ = ('f', 'level', 'lower', 'upper')
+
+    def __init__(self, f, level, lower, upper):
+        self.f = f
+        self.level = level
+        self.lower = lower
+        self.upper = upper
+
+
+def log_bin(f, den, fraction=24):
+    """ Bin a PSD onto a 1/FRACTION-octave grid. The level of
+        each band is the mean power; the envelope is the min/max
+        of the bins it contains. DC is dropped (no place on a
+        log axis).
+
+        :returns: a BinnedSpectrum
+    """
+    f = np.asarray(f)[1:]
+    den = np.asarray(den)[1:]
+    # DEN is a power density, so levels are 10*log10. Earlier 
+    # releases plotted 20*log10, which doubled every level in dB.
+    db = 10 * np.log10(np.maximum(den, 1e-300))
+
+    # Band edges from the first bin up to Nyquist
+    num_bands = int(np.ceil(fraction * np.log2(f[-1] / f[0]))) + 1
+    edges = f[0] * 2**((np.arange(num_bands + 1) - 0.5) / fraction)
+    band = np.searchsorted(edges, f, side='right') - 1
+
+    # Bins are sorted, so each band is a contiguous run
+    starts = np.flatnonzero(np.r_[True, np.diff(band) != 0])
+    counts = np.diff(np.r_[starts, len(f)])
+    power = np.add.reduceat(den, starts) / counts
+    centres = np.add.reduceat(f, starts) / counts
+
+    return BinnedSpectrum(
+        f=centres,
+        level=10 * np.log10(np.maximum(power, 1e-300)),
+        lower=np.minimum.reduceat(db, starts),
+        upper=np.maximum.reduceat(db, starts)
+    )
+
+
+class PlotCache:
+    """ Binned spectra per (channel, kind), computed once per
+        result and reused by every redraw.
+    """
+    def __init__(self, fraction=24):
+        self.fraction = fraction
+        self._cache = {}
+
+
+    def set(self, channel, kind, f, den):
+        self._cache[(channel, kind)] = log_bin(f, den, self.fraction)
+
+
+    def get(self, channel, kind):
+        return self._cache.get((channel, kind))
+
+
+    def clear(self):
+        self._cache.clear()
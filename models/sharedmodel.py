@@ -0,0 +1,250 @@
+""" Process-pool channel shaping over shared memory. The parent
+    copies the stimulus into a shared block once and preallocates
+    a shared channel-major (C, N) output buffer; worker processes
+    attach to both by name, read their channel and write their
+    noise in place. Only small descriptors and the (small) spectra cross
+    the process boundary.
+
+    Usage:
+        with sharedmodel.process_pool(4) as pool:
+            for audio in stimuli:
+                with sharedmodel.SharedArray((num_channels, 
+                        num_noise)) as out:
+                    for ii, result in sharedmodel.shape_channels(
+                            audio, fs, correlated, out, pool=pool):
+                        ...
+                    writemodel.write(path, out.array, fs, 
+                        channel_major=True)
+"""
+
+###########
+# Imports #
+###########
+# Data Science
+import numpy as np
+
+# System
+from multiprocessing import shared_memory
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Custom
+from models import audiomodel
+from models import fftmodel
+from models import noisemodel
+
+
+#########
+# BEGIN #
+#########
+class SharedArray:
+    """ A numpy array in a named shared-memory block.
+
+        Create a new block with SharedArray(shape, dtype) or
+        attach to an existing one with SharedArray.attach(). The
+        creator unlinks the block on close().
+    """
+    def __init__(self, shape, dtype=np.float64, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self._owner = name is None
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(self.shape, dtype=self.dtype,
+            buffer=self._shm.buf)
+
+
+    @classmethod
+    def attach(cls, descriptor):
+        """ Attach to a block described by descriptor(). """
+        name, shape, dtype = descriptor
+        return cls(shape, dtype, name=name)
+
+
+    def descriptor(self):
+        """ (name, shape, dtype): all a process needs to attach. """
+        return (self._shm.name, self.shape, self.dtype.str)
+
+
+    def close(self):
+        # Views into the buffer must be released before closing
+        self.array = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_shared(file_path):
+    """ Decode an audio file straight into shared memory, so 
+        the stimulus is held once for the parent and every worker.
+
+        :returns: a channel-major (C, N) SharedArray
+    """
+    audio = audiomodel.Audio(file_path, load=False)
+    shared = SharedArray((audio.num_channels, audio.frames))
+    audio.load(out=shared.array)
+    if audio.frames < shared.shape[1]:
+        # The header overstated the length: move to an exact block
+        exact = SharedArray(audio.data.shape)
+        exact.array[...] = audio.data
+        audio.data = None
+        shared.close()
+        shared = exact
+    return shared
+
+
+def process_pool(processes=None):
+    """ A pool of worker processes for shape_channels(). Create 
+        it once and reuse it for every file: starting a process 
+        (and importing numpy and scipy in it) is expensive, 
+        especially where processes are spawned (Windows). Workers 
+        keep as many noise realizations in memory as the parent's 
+        noise provider.
+    """
+    return ProcessPoolExecutor(max_workers=processes,
+        initializer=_init_worker,
+        initargs=(noisemodel.noise_provider.cache_dir,
+            noisemodel.noise_provider.max_items))
+
+
+def _init_worker(noise_cache, max_items):
+    """ Worker process setup: share the correlated noise cache
+        directory (if any) and the in-memory limit with the parent.
+    """
+    noisemodel.set_noise_cache(noise_cache)
+    noisemodel.noise_provider.max_items = max_items
+
+
+def _shape_channel(ii, stimulus, output, spectrum, fs, correlated,
+        seed, workers, kwargs):
+    """ Worker: shape channel II. Reads the stimulus channel from
+        shared memory (unless its SPECTRUM is given) and writes the
+        noise into row II of the shared output.
+
+        :returns: the ShapedNoise without its noise array
+    """
+    out = SharedArray.attach(output)
+    stim = SharedArray.attach(stimulus) if stimulus else None
+    try:
+        audio = None
+        if spectrum is None:
+            # Channel-major stimulus: one contiguous row per channel
+            audio = stim.array[ii]
+        result = noisemodel.shape_noise(
+            audio=audio,
+            fs=fs,
+            correlated=correlated,
+            seed=seed,
+            workers=workers,
+            spectrum=spectrum,
+            **kwargs
+        )
+        out.array[ii] = result.noise
+        result.noise = None
+        return result
+    finally:
+        out.close()
+        if stim is not None:
+            stim.close()
+
+
+def shape_channels(audio, fs, correlated, out, processes=None,
+        workers=None, seed=None, spectrum=None, channel_major=False,
+        pool=None, stimulus=None, **kwargs):
+    """ Shape every channel of AUDIO in a pool of worker processes.
+        The counterpart of noisemodel.shape_channels() for work
+        that does not scale with threads.
+
+        audio: a 1-D or (N, C) array, or a (C, N) array if
+            CHANNEL_MAJOR, copied once into shared memory
+            (channel-major). May be None if SPECTRUM is given, in
+            which case only the output is shared.
+        stimulus: a channel-major SharedArray holding the stimulus
+            (see read_shared()), used in place of AUDIO without a
+            copy. The caller closes it.
+        out: a SharedArray of shape (C, noise length); see
+            noisemodel.noise_length()
+        processes: channels shaped at once (default: the thread
+            budget; at most one per channel)
+        workers: total thread budget, split between processes and
+            scipy.fft workers within each
+        pool: a process_pool() to run in. By default a pool is
+            started for this call and shut down afterwards.
+        seed, spectrum, kwargs: see noisemodel.shape_channels()
+
+        :yields: (channel index, ShapedNoise) tuples in channel
+            order. The noise is in OUT; result.noise is None.
+    """
+    if spectrum is not None:
+        num_channels = spectrum.num_channels
+        stimulus = None
+    elif stimulus is not None:
+        num_channels = stimulus.shape[0]
+    elif channel_major:
+        audio = np.atleast_2d(audio)
+        num_channels = audio.shape[0]
+    else:
+        audio = np.atleast_2d(audio.T)
+        num_channels = audio.shape[0]
+    if processes:
+        processes = min(num_channels, processes)
+        fft_workers = max(1, (workers or fftmodel.config.workers) 
+            // processes)
+    else:
+        processes, fft_workers = fftmodel.split_workers(num_channels, 
+            workers)
+    seeds = np.random.SeedSequence(seed).spawn(num_channels)
+
+    # Map the stimulus once; workers attach by name
+    own_stimulus = spectrum is None and stimulus is None
+    if own_stimulus:
+        stimulus = SharedArray(audio.shape)
+        stimulus.array[...] = audio
+
+    print(f"sharedmodel: Shaping {num_channels} channel(s) in " +
+        f"{processes} process(es) x {fft_workers} FFT worker(s)")
+    def _submit(ii):
+        return pool.submit(
+            _shape_channel,
+            ii,
+            stimulus.descriptor() if stimulus else None,
+            out.descriptor(),
+            spectrum.channel(ii) if spectrum is not None else None,
+            fs,
+            correlated,
+            seeds[ii],
+            fft_workers,
+            kwargs
+        )
+
+    own_pool = pool is None
+    if own_pool:
+        pool = process_pool(processes)
+    pending = deque()
+    try:
+        # At most PROCESSES channels in flight, even in a larger pool
+        pending.extend(_submit(ii) 
+            for ii in range(min(processes, num_channels)))
+        for ii in range(num_channels):
+            result = pending.popleft().result()
+            if ii + processes < num_channels:
+                pending.append(_submit(ii + processes))
+            yield ii, result
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_pool:
+            pool.shutdown()
+        if own_stimulus:
+            stimulus.close()
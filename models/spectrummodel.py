@@ -0,0 +1,513 @@
+""" Stimulus analysis: long-term average spectrum (Welch PSD)
+    and RMS of every channel, computed in one axis-aware pass.
+
+    Usage:
+        spectrum = spectrummodel.analyse(audio, fs)
+        result = noisemodel.shape_noise(None, fs, correlated,
+            spectrum=spectrum.channel(0))
+
+        # Same result, one block in memory at a time
+        spectrum = spectrummodel.analyse_blocks('long.wav')
+
+        # Subsampled estimate of a very long file
+        spectrum = spectrummodel.estimate('long.wav', tolerance=0.5)
+
+        # Corpus long-term average spectrum (LTASS)
+        ltass = spectrummodel.analyse_corpus(paths)
+        result = noisemodel.shape_noise(None, ltass.fs, correlated,
+            spectrum=ltass.spectrum())
+"""
+
+###########
+# Imports #
+###########
+# Data Science
+import numpy as np
+from scipy import fft as sp_fft
+from scipy import stats
+
+# System
+import os
+import json
+import time
+from functools import reduce
+from concurrent.futures import ProcessPoolExecutor
+
+# Audio
+import soundfile as sf
+
+# Custom
+from models import fftmodel
+
+
+#########
+# BEGIN #
+#########
+class Spectrum:
+    """ Welch PSD and RMS of one or more channels.
+
+        f: frequencies (Hz)
+        den: PSD, shape (C, F) or (F,) for a single channel
+        rms: RMS, shape (C,) or a float for a single channel
+        num_samples: stimulus length in samples
+        info: details of the estimate (e.g., segments, timings)
+    """
+    __slots__ = ('f', 'den', 'rms', 'num_samples', 'info')
+
+    def __init__(self, f, den, rms, num_samples, info=None):
+        self.f = f
+        self.den = den
+        self.rms = rms
+        self.num_samples = num_samples
+        self.info = info if info is not None else {}
+
+
+    @property
+    def num_channels(self):
+        return 1 if np.ndim(self.den) == 1 else len(self.den)
+
+
+    def channel(self, ii):
+        """ Return a single-channel Spectrum. """
+        if np.ndim(self.den) == 1:
+            return self
+        return Spectrum(self.f, self.den[ii], float(self.rms[ii]),
+            self.num_samples, dict(self.info))
+
+
+def analyse(audio, fs, nperseg=2048, channel_major=False):
+    """ Compute the Welch PSD and RMS of every channel of AUDIO
+        in one call.
+
+        audio: a 1-D array, an interleaved (N, C) array, or a
+            (C, N) array if CHANNEL_MAJOR
+        channel_major: AUDIO is already (C, N). Otherwise it is
+            converted once to a contiguous channel-major copy so
+            every channel is read with unit stride.
+
+        :returns: a Spectrum with den of shape (C, F)
+    """
+    start = time.perf_counter()
+    if channel_major:
+        x = np.atleast_2d(audio)
+    else:
+        x = np.ascontiguousarray(np.atleast_2d(audio.T))
+    num_channels, num_samples = x.shape
+    print(f"spectrummodel: Analysing {num_channels} channel(s)")
+
+    # Segments are shortened for signals shorter than NPERSEG
+    nperseg = min(nperseg, num_samples)
+    f, den = fftmodel.welch(x, fs, nperseg=nperseg, axis=-1)
+    # Sum of squares without a temporary (C, N) array
+    rms = np.sqrt(np.einsum('ij,ij->i', x, x) / num_samples)
+
+    info = {'nperseg': nperseg, 'time': time.perf_counter() - start}
+    return Spectrum(f, den, rms, num_samples, info)
+
+
+def analyse_blocks(source, fs=None, nperseg=2048, block_segments=256):
+    """ Welch PSD and RMS computed one block of segments at a 
+        time. Gives the same result as analyse(), but only one 
+        block is held in memory (read from disk if SOURCE is a 
+        file), so long or many-channel stimuli fit a fixed 
+        memory budget.
+
+        source: a 1-D or (N, C) array (with FS), or the path of 
+            an audio file
+        block_segments: Welch segments per block
+
+        :returns: a Spectrum with den of shape (C, F)
+    """
+    start = time.perf_counter()
+    reader = _SegmentReader(source, fs)
+    fs = reader.fs
+    num_samples = reader.num_samples
+    nperseg = min(nperseg, num_samples)
+    step = nperseg - nperseg // 2
+    num_segments = (num_samples - nperseg) // step + 1
+
+    den_sum = 0.0
+    sum_squares = 0.0
+    counted = 0
+    for first in range(0, num_segments, block_segments):
+        count = min(block_segments, num_segments - first)
+        offset = first * step
+        x = reader.read_span(offset, (count - 1) * step + nperseg)
+        # Samples not yet counted in the RMS
+        new = x[:, counted - offset:]
+        sum_squares = sum_squares + np.einsum('cn,cn->c', new, new)
+        counted = offset + x.shape[1]
+
+        frames = np.lib.stride_tricks.sliding_window_view(x, nperseg, 
+            axis=-1)[:, ::step]
+        den_sum = den_sum + _periodograms(frames, fs).sum(axis=1)
+
+    # Samples after the last segment
+    if counted < num_samples:
+        tail = reader.read_span(counted, num_samples - counted)
+        sum_squares = sum_squares + np.einsum('cn,cn->c', tail, tail)
+    reader.close()
+
+    f = sp_fft.rfftfreq(nperseg, 1/fs)
+    info = {'nperseg': nperseg, 'blocks': -(-num_segments // block_segments),
+        'time': time.perf_counter() - start}
+    return Spectrum(f, den_sum / num_segments, 
+        np.sqrt(sum_squares / num_samples), num_samples, info)
+
+
+def _periodograms(frames, fs):
+    """ One-sided Hann-windowed periodograms of FRAMES (segments 
+        along the last axis) with Welch's density scaling and 
+        per-segment mean removal, as scipy.signal.welch computes 
+        them.
+    """
+    nperseg = frames.shape[-1]
+    window = fftmodel.get_window('hann', nperseg)
+    scale = 1.0 / (fs * np.sum(window**2))
+    frames = frames - frames.mean(axis=-1, keepdims=True)
+    spec = np.abs(sp_fft.rfft(frames * window, axis=-1))**2 * scale
+    spec[..., 1:(nperseg + 1) // 2] *= 2
+    return spec
+
+
+##########################
+# Subsampled Estimation #
+##########################
+def estimate(source, fs=None, nperseg=2048, tolerance=0.5, 
+        confidence=0.95, strategy='random', batch=32, min_segments=32,
+        max_segments=None, seed=None):
+    """ Estimate the Welch PSD from randomly sampled segments, 
+        stopping once every bin has converged. Only the sampled 
+        segments are read, so long files take sub-linear time.
+
+        source: a 1-D or (N, C) array (with FS), or the path of 
+            an audio file
+        tolerance: stop when the confidence bound of every bin 
+            (within 60 dB of the peak) is below TOLERANCE dB
+        confidence: confidence level of the bound
+        strategy: 'random' (uniform segment positions) or 
+            'stratified' (one random segment per equal-length 
+            stratum, strata visited in random order)
+        batch: segments read between convergence checks
+        max_segments: upper limit on segments read (default: the 
+            number of non-overlapping segments)
+
+        :returns: a Spectrum. info records the number of segments 
+            used, the achieved error bound (dB) and whether the 
+            estimate converged. RMS is estimated from the same 
+            segments.
+    """
+    start = time.perf_counter()
+    reader = _SegmentReader(source, fs)
+    fs = reader.fs
+    num_samples = reader.num_samples
+    nperseg = min(nperseg, num_samples)
+    rng = np.random.default_rng(seed)
+
+    # Short stimuli: a full Welch estimate is cheaper
+    if num_samples < min_segments * nperseg:
+        spectrum = analyse(reader.read_all(), fs, nperseg=nperseg,
+            channel_major=True)
+        reader.close()
+        spectrum.info['subsampled'] = False
+        return spectrum
+
+    # Segment positions, consumed in batches
+    num_positions = num_samples - nperseg + 1
+    if not max_segments:
+        max_segments = max(1, num_samples // nperseg)
+    if strategy == 'stratified':
+        edges = np.linspace(0, num_positions, max_segments + 1)
+        widths = np.maximum(np.diff(edges), 1)
+        positions = (edges[:-1] + rng.random(max_segments) * widths)
+        positions = rng.permutation(positions.astype(np.int64))
+    elif strategy == 'random':
+        positions = rng.integers(0, num_positions, max_segments)
+    else:
+        raise ValueError(f"Unknown sampling strategy: {strategy}")
+
+    z = stats.norm.ppf((1 + confidence) / 2)
+
+    count = 0
+    mean = None
+    m2 = None
+    sum_squares = 0.0
+    bound = np.inf
+    while count < len(positions):
+        # Read a batch of segments: (C, B, nperseg)
+        frames = reader.read(positions[count:count+batch], nperseg)
+        sum_squares = sum_squares + np.einsum('cbn,cbn->c', frames, frames)
+        spec = _periodograms(frames, fs)
+
+        # Running mean and variance (Chan et al. batch update)
+        num_new = spec.shape[1]
+        batch_mean = spec.mean(axis=1)
+        batch_m2 = ((spec - batch_mean[:, None, :])**2).sum(axis=1)
+        if mean is None:
+            mean, m2 = batch_mean, batch_m2
+        else:
+            delta = batch_mean - mean
+            total = count + num_new
+            mean = mean + delta * num_new / total
+            m2 = m2 + batch_m2 + delta**2 * count * num_new / total
+        count += num_new
+
+        # Confidence bound on the mean, in dB
+        if count >= 2:
+            floor = mean.max(axis=-1, keepdims=True) * 1e-6
+            rel_se = np.sqrt(m2 / (count - 1) / count) / np.maximum(mean, 1e-300)
+            bound = float(np.max(10 * np.log10(1 + z * rel_se[mean > floor])))
+            if bound <= tolerance and count >= min_segments:
+                break
+
+    reader.close()
+    converged = bound <= tolerance
+    print(f"spectrummodel: Used {count} of {num_positions} possible " +
+        f"segments (error bound: {np.round(bound, 2)} dB" +
+        f"{'' if converged else ', not converged'})")
+
+    f = sp_fft.rfftfreq(nperseg, 1/fs)
+    rms = np.sqrt(sum_squares / (count * nperseg))
+    info = {
+        'nperseg': nperseg,
+        'segments': count,
+        'error_bound_db': bound,
+        'confidence': confidence,
+        'converged': converged,
+        'strategy': strategy,
+        'subsampled': True,
+        'time': time.perf_counter() - start
+    }
+    return Spectrum(f, mean, rms, num_samples, info)
+
+
+class _SegmentReader:
+    """ Read short segments from an array or an audio file. """
+    def __init__(self, source, fs=None):
+        if isinstance(source, np.ndarray):
+            self._file = None
+            self._data = source if source.ndim == 2 else source[:, None]
+            self.fs = fs
+            self.num_samples = len(source)
+        else:
+            self._file = sf.SoundFile(source)
+            self.fs = self._file.samplerate
+            self.num_samples = self._file.frames
+
+
+    def read(self, positions, nperseg):
+        """ :returns: segments as a (C, B, NPERSEG) array """
+        if self._file is None:
+            index = positions[:, None] + np.arange(nperseg)
+            return np.ascontiguousarray(
+                np.moveaxis(self._data[index], -1, 0), dtype=float)
+        frames = np.empty((self._file.channels, len(positions), nperseg))
+        for ii, pos in enumerate(positions):
+            self._file.seek(int(pos))
+            frames[:, ii, :] = self._file.read(nperseg, always_2d=True).T
+        return frames
+
+
+    def read_span(self, start, length):
+        """ :returns: LENGTH samples from START as a (C, LENGTH) 
+            array
+        """
+        if self._file is None:
+            return np.ascontiguousarray(self._data[start:start+length].T, 
+                dtype=float)
+        self._file.seek(int(start))
+        return np.ascontiguousarray(
+            self._file.read(int(length), always_2d=True).T)
+
+
+    def read_all(self):
+        """ :returns: the whole signal as a (C, N) array """
+        if self._file is None:
+            return np.ascontiguousarray(self._data.T, dtype=float)
+        self._file.seek(0)
+        return np.ascontiguousarray(self._file.read(always_2d=True).T)
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+###############
+# Corpus Mode #
+###############
+class LTASS:
+    """ Mergeable accumulator for the long-term average spectrum 
+        of a corpus of files. Channels are averaged within each 
+        file; files are weighted by their length, so the result is 
+        the spectrum and energy-weighted RMS of the whole corpus 
+        played end to end. 
+
+        merge() is associative, so partial results from worker 
+        processes or earlier runs can be combined in any grouping.
+    """
+    def __init__(self, fs=None, nperseg=2048):
+        self.fs = fs
+        self.nperseg = nperseg
+        self.f = None
+        # Sample-weighted sum of PSDs
+        self.den_sum = None
+        self.sum_squares = 0.0
+        self.num_samples = 0
+        # Analysed files: path -> [size, mtime]
+        self.files = {}
+
+
+    def __add__(self, other):
+        return self.merge(other)
+
+
+    def add(self, spectrum, fs, key=None):
+        """ Add a (possibly multichannel) Spectrum of one file. """
+        den = np.atleast_2d(spectrum.den).mean(axis=0)
+        rms = np.atleast_1d(spectrum.rms)
+        part = LTASS(fs, spectrum.info.get('nperseg', self.nperseg))
+        part.f = spectrum.f
+        part.den_sum = den * spectrum.num_samples
+        part.sum_squares = float(np.mean(rms**2) * spectrum.num_samples)
+        part.num_samples = spectrum.num_samples
+        if key is not None:
+            part.files[key] = _file_stamp(key)
+
+        merged = self.merge(part)
+        self.__dict__.update(merged.__dict__)
+
+
+    def merge(self, other):
+        """ Return a new LTASS combining SELF and OTHER. """
+        if self.num_samples == 0 and not self.files:
+            return other._copy()
+        if other.num_samples == 0 and not other.files:
+            return self._copy()
+        if (self.fs != other.fs or self.nperseg != other.nperseg
+                or len(self.f) != len(other.f)):
+            raise ValueError("Cannot merge spectra with different " +
+                f"sampling rates or resolution ({self.fs} Hz/" +
+                f"{self.nperseg} vs {other.fs} Hz/{other.nperseg})")
+
+        merged = LTASS(self.fs, self.nperseg)
+        merged.f = self.f
+        merged.den_sum = self.den_sum + other.den_sum
+        merged.sum_squares = self.sum_squares + other.sum_squares
+        merged.num_samples = self.num_samples + other.num_samples
+        merged.files = {**self.files, **other.files}
+        return merged
+
+
+    def _copy(self):
+        copy = LTASS(self.fs, self.nperseg)
+        copy.__dict__.update(self.__dict__)
+        copy.files = dict(self.files)
+        return copy
+
+
+    def is_current(self, path):
+        """ True if PATH was analysed and has not changed since. """
+        key = os.path.abspath(path)
+        return self.files.get(key) == _file_stamp(key)
+
+
+    def spectrum(self):
+        """ The corpus LTASS as a single-channel Spectrum. """
+        if not self.num_samples:
+            raise ValueError("No files have been analysed")
+        return Spectrum(
+            f=self.f,
+            den=self.den_sum / self.num_samples,
+            rms=float(np.sqrt(self.sum_squares / self.num_samples)),
+            num_samples=self.num_samples,
+            info={'nperseg': self.nperseg, 'files': len(self.files)}
+        )
+
+
+    def save(self, file_path):
+        """ Save the accumulator as .npz for later runs. An empty 
+            accumulator (no file analysed) is not saved.
+        """
+        if not self.num_samples:
+            print("spectrummodel: No files analysed; not saving " +
+                f"{file_path}")
+            return
+        np.savez(file_path, fs=self.fs, nperseg=self.nperseg, f=self.f,
+            den_sum=self.den_sum, sum_squares=self.sum_squares,
+            num_samples=self.num_samples, files=json.dumps(self.files))
+
+
+    @classmethod
+    def load(cls, file_path):
+        """ Load an accumulator saved with save(). """
+        with np.load(file_path) as data:
+            ltass = cls(int(data['fs']), int(data['nperseg']))
+            ltass.f = data['f']
+            ltass.den_sum = data['den_sum']
+            ltass.sum_squares = float(data['sum_squares'])
+            ltass.num_samples = int(data['num_samples'])
+            ltass.files = json.loads(str(data['files']))
+        return ltass
+
+
+def _file_stamp(path):
+    """ Size and modification time used to detect changed files. """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def _analyse_file(path, nperseg):
+    """ Map step: analyse one file into a partial LTASS. Files 
+        shorter than one segment would give a coarser spectrum 
+        that cannot be merged; they are skipped (empty LTASS).
+    """
+    frames = sf.info(path).frames
+    if frames < nperseg:
+        print(f"spectrummodel: Skipping {os.path.basename(path)}: " +
+            f"{frames} samples is shorter than one {nperseg}-sample " +
+            "segment")
+        return LTASS(nperseg=nperseg)
+    audio, fs = sf.read(path)
+    # One FFT worker: files already run in parallel
+    with fftmodel.fft_workers(1):
+        spectrum = analyse(audio, fs, nperseg=nperseg)
+    ltass = LTASS(fs, nperseg)
+    ltass.add(spectrum, fs, key=os.path.abspath(path))
+    return ltass
+
+
+def analyse_corpus(paths, nperseg=2048, processes=None, ltass=None):
+    """ Compute the LTASS of a corpus of audio files in parallel 
+        (map) and merge the partial results (reduce).
+
+        paths: audio file paths
+        processes: number of worker processes (default: CPU count)
+        ltass: an earlier LTASS to extend. Files it already 
+            covers (unchanged size and modification time) are 
+            not analysed again. If any of its files changed or is 
+            no longer in PATHS, the corpus is analysed from scratch.
+
+        :returns: an LTASS
+    """
+    ltass = ltass if ltass is not None else LTASS(nperseg=nperseg)
+    # A changed or removed file cannot be subtracted from the 
+    # running sums
+    listed = {os.path.abspath(p) for p in paths}
+    stale = [key for key in ltass.files 
+        if key not in listed or not ltass.is_current(key)]
+    if stale:
+        print(f"spectrummodel: {len(stale)} file(s) changed or " +
+            "removed since the last run; analysing the corpus from " +
+            "scratch")
+        ltass = LTASS(nperseg=ltass.nperseg)
+    new_paths = [p for p in paths if not ltass.is_current(p)]
+    print(f"spectrummodel: Analysing {len(new_paths)} new file(s) " +
+        f"({len(paths) - len(new_paths)} already analysed)")
+    if not new_paths:
+        return ltass
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        parts = pool.map(_analyse_file, new_paths, 
+            [ltass.nperseg] * len(new_paths), chunksize=4)
+        return reduce(LTASS.merge, parts, ltass)
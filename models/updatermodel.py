@@ -11,8 +11,8 @@
 ###########
 # Imports #
 ###########
-# Data science
-import pandas as pd
+# Data
+import csv
 
 # GUI
 from tkinter import messagebox
@@ -58,7 +58,8 @@ class VersionChecker:
         """
         # Download version library for crossreferencing
         try:
-            self.version_library = pd.read_csv(lib_path)
+            with open(lib_path, newline='', encoding='utf-8-sig') as f:
+                self.version_library = list(csv.DictReader(f))
         except FileNotFoundError:
             raise FileNotFoundError
             
@@ -67,30 +68,30 @@ class VersionChecker:
         """ Check app version against latest available version from library.
         """
         # Retrieve app record from library 
-        bools = self.version_library['name']==self.app_name
-        status = self.version_library[bools]
+        status = [record for record in self.version_library 
+            if record['name'] == self.app_name]
 
         # Check whether current version matches version library
         try:
-            if status.iloc[0]['version'] != self.app_version:
+            if status[0]['version'] != self.app_version:
                 print('\nupdater: New version available!')
                 print(f"updater: You are using version {self.app_version}, but " +
-                    f"version {status.iloc[0]['version']} is available.")
-                if status.iloc[0]['mandatory'] == 'yes':
+                    f"version {status[0]['version']} is available.")
+                if status[0]['mandatory'] == 'yes':
                     messagebox.showerror(
                         title="New Version Available",
                         message=f"Mandatory software update required!",
                         detail=f"You must download version " +
-                        f"{status.iloc[0]['version']} to continue."
+                        f"{status[0]['version']} to continue."
                     )
                     self.current = False
                     return
-                elif status.iloc[0]['mandatory'] == 'no':
+                elif status[0]['mandatory'] == 'no':
                     messagebox.showwarning(
                         title="New Version Available",
                         message=f"Software update available!",
                         detail=f"Please download {self.app_name} " + 
-                        f"version {status.iloc[0]['version']}."
+                        f"version {status[0]['version']}."
                     )
                 self.current = True
                 return
@@ -0,0 +1,210 @@
+""" Functions that handle writing calibration files.
+"""
+
+###########
+# Imports #
+###########
+# Import system packages
+import os
+import time
+import uuid
+
+# Import data science packages
+import numpy as np
+
+# Import audio packages
+import soundfile as sf
+
+
+#############
+# Constants #
+#############
+SOFTWARE = 'Noise Shaper'
+
+# Output sample formats offered to the user ('match' keeps the 
+# format of the stimulus)
+SUBTYPES = ('match', 'PCM_16', 'PCM_24', 'PCM_32', 'FLOAT')
+
+# File formats by extension. RF64 and W64 hold files over 4 GB; 
+# FLAC is lossless compressed PCM (at most 24 bits).
+FORMATS = {'.wav': 'WAV', '.flac': 'FLAC', '.w64': 'W64', '.rf64': 'RF64'}
+_FLAC_SUBTYPES = ('PCM_S8', 'PCM_16', 'PCM_24')
+_FLAC_MAX_CHANNELS = 8
+
+# Largest file a plain WAV header can describe
+_WAV_LIMIT = 2**32 - 1
+
+# Bytes per sample on disk (for throughput reports)
+_SAMPLE_BYTES = {'PCM_16': 2, 'PCM_24': 3, 'PCM_32': 4, 'FLOAT': 4, 
+    'DOUBLE': 8}
+
+# Bits and container dtype of the PCM formats written as integers
+# (24-bit samples are passed to libsndfile left-justified in int32)
+_PCM = {'PCM_16': (16, np.int16), 'PCM_24': (24, np.int32), 
+    'PCM_32': (32, np.int32)}
+
+# Shaping options recorded in the file metadata
+METADATA_KEYS = ('preset', 'engine', 'nperseg', 'method', 'duration',
+    'loopable')
+
+
+#########
+# BEGIN #
+#########
+def write(file_path, data, fs, metadata=None, subtype=None, 
+        source_subtype=None, dither=True, blocksize=2**16, seed=None,
+        progress=None, compression=None, channel_major=False):
+    """ Write audio to FILE_PATH. METADATA (a dict) is stored
+        in the file's comment field as 'key=value; ...'.
+
+        The file is written to a temporary file in the same 
+        directory and renamed to FILE_PATH only once complete, so 
+        an interrupted write never leaves a truncated file behind.
+
+        subtype: one of SUBTYPES (default: the soundfile default 
+            for the format). 'match' uses SOURCE_SUBTYPE.
+        dither: add TPDF dither before quantizing to PCM
+        compression: FLAC compression level, 0 (fastest) to 8 
+            (smallest). Does not change the samples.
+        progress: called as progress(fraction, bytes_written) 
+            after each block
+        channel_major: DATA is (C, N) rather than interleaved 
+            (N, C). Each block is interleaved as it is converted.
+
+        Samples are converted one block at a time and clipped to 
+        the integer range, so no full-size copy is made and 
+        out-of-range samples cannot wrap around.
+
+        :returns: the subtype written
+    """
+    subtype = resolve_subtype(subtype, source_subtype)
+    if data.ndim == 1:
+        channels, num_frames, channel_major = 1, len(data), False
+    elif channel_major:
+        channels, num_frames = data.shape
+    else:
+        num_frames, channels = data.shape
+    rng = np.random.default_rng(seed)
+    clipped = 0
+    start_time = time.perf_counter()
+
+    # Temporary file next to the target (same file system)
+    directory, name = os.path.split(os.path.abspath(file_path))
+    file_format, subtype = _resolve_format(name, subtype, 
+        data.size * _SAMPLE_BYTES.get(subtype, 2), channels)
+    options = {}
+    if file_format == 'FLAC' and compression is not None:
+        options['compression_level'] = min(max(compression, 0), 8) / 8
+    temp_path = os.path.join(directory, 
+        f".{name}.{uuid.uuid4().hex[:8]}.part")
+
+    try:
+        with sf.SoundFile(temp_path, 'w', fs, channels, subtype=subtype, 
+                format=file_format, **options) as f:
+            try:
+                f.software = SOFTWARE
+                if metadata:
+                    f.comment = format_metadata(metadata)
+            except sf.LibsndfileError:
+                print(f"writemodel: {file_format} files cannot hold " +
+                    "metadata")
+            subtype = f.subtype
+            frame_bytes = channels * _SAMPLE_BYTES.get(subtype, 4)
+            for start in range(0, num_frames, blocksize):
+                if channel_major:
+                    block = data[:, start:start+blocksize].T
+                else:
+                    block = data[start:start+blocksize]
+                block, num_clipped = _convert(block, subtype, dither, rng)
+                f.write(block)
+                clipped += num_clipped
+                if progress:
+                    written = min(start + blocksize, num_frames)
+                    progress(written / num_frames, written * frame_bytes)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    if clipped:
+        print(f"writemodel: {clipped} samples clipped!")
+    elapsed = time.perf_counter() - start_time
+    size = os.path.getsize(file_path) / 1e6
+    print(f"writemodel: Wrote {file_path} ({file_format} {subtype}, " +
+        f"{np.round(size, 1)} MB at {np.round(size / elapsed, 1)} MB/s)")
+    return subtype
+
+
+def _resolve_format(name, subtype, num_bytes, channels=1):
+    """ File format from the extension of NAME, and a subtype 
+        the format can hold. WAV files larger than 4 GB are 
+        written as RF64.
+
+        :returns: (format, subtype)
+        :raises ValueError: if the format cannot hold CHANNELS
+    """
+    file_format = FORMATS.get(os.path.splitext(name)[1].lower(), 
+        os.path.splitext(name)[1][1:].upper() or 'WAV')
+    if file_format == 'WAV' and num_bytes > _WAV_LIMIT:
+        print("writemodel: Over 4 GB; writing an RF64 file")
+        file_format = 'RF64'
+    if file_format == 'FLAC' and subtype and \
+            subtype not in _FLAC_SUBTYPES:
+        print(f"writemodel: FLAC cannot hold {subtype}; using PCM_24")
+        subtype = 'PCM_24'
+    if file_format == 'FLAC' and channels > _FLAC_MAX_CHANNELS:
+        raise ValueError(f"FLAC holds at most {_FLAC_MAX_CHANNELS} " +
+            f"channels, not {channels}. Use WAV, W64 or RF64 instead.")
+    return file_format, subtype
+
+
+def resolve_subtype(subtype, source_subtype=None):
+    """ Map an output format option to a soundfile subtype. 
+        'match' keeps SOURCE_SUBTYPE if it is a PCM or float 
+        format, and falls back to FLOAT otherwise.
+    """
+    if subtype != 'match':
+        return subtype
+    if source_subtype in _PCM or source_subtype in ('FLOAT', 'DOUBLE'):
+        return source_subtype
+    return 'FLOAT'
+
+
+def _convert(block, subtype, dither, rng):
+    """ Quantize one block of float samples for SUBTYPE. The 
+        result is always C-ordered, so a transposed (channel-
+        major) block is interleaved by the first copy.
+
+        :returns: (converted block, number of clipped samples)
+    """
+    if subtype not in _PCM:
+        return block.astype(np.float32 if subtype == 'FLOAT' 
+            else np.float64, order='C'), 0
+
+    bits, dtype = _PCM[subtype]
+    full_scale = 2.0**(bits - 1)
+    scaled = np.multiply(block, full_scale, order='C')
+    if dither:
+        # Triangular PDF, +/- 1 LSB
+        scaled += rng.random(block.shape)
+        scaled -= rng.random(block.shape)
+    np.rint(scaled, out=scaled)
+    clipped = np.count_nonzero((scaled < -full_scale) | 
+        (scaled > full_scale - 1))
+    np.clip(scaled, -full_scale, full_scale - 1, out=scaled)
+    out = scaled.astype(dtype)
+    if bits == 24:
+        out <<= 8
+    return out, clipped
+
+
+def format_metadata(metadata):
+    """ Convert shaping info into a metadata string. Only the
+        options in METADATA_KEYS are kept.
+    """
+    def _fmt(value):
+        return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+    return '; '.join(f"{key}={_fmt(metadata[key])}" for key in METADATA_KEYS
+        if metadata.get(key) is not None)
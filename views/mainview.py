@@ -97,10 +97,67 @@ class MainFrame(ttk.Frame):
         # Options
         
 
-        # Create plot
+        # Channel selector for the plot
+        self.cmb_channel = ttk.Combobox(self.lblfrm_plots, 
+            textvariable=self._vars['plot_channel'], state='readonly',
+            width=15)
+        self.cmb_channel.grid(column=0, row=0, sticky='w', padx=10)
+        self.cmb_channel.bind('<<ComboboxSelected>>', 
+            lambda _: self.winfo_toplevel().event_generate('<<NoisePlot>>'))
+
+        # Create plot once; lines are updated in place
         self.fig = Figure(figsize=(5.5,4), dpi=75)
         self.ax = self.fig.add_subplot(1,1,1)
-        self.ax.set_ylabel("Power Spectral Density")
+        self.ax.set_ylabel("Power Spectral Density (dB)")
         self.ax.set_xlabel("Frequency (Hz)")
+        self.line_stim, = self.ax.plot([], [], color="blue", 
+            label="stimulus", linewidth=3)
+        self.line_noise, = self.ax.plot([], [], ls=":", linewidth=3, 
+            color="orange", label="Filtered Noise")
+        self.envelopes = []
+        self.ax.set_xscale('log')
+        self.ax.legend()
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.lblfrm_plots)
         self.canvas.get_tk_widget().grid(column=0, row=5, **options_data)
+
+
+    def set_channels(self, num_channels):
+        """ Fill the channel selector. """
+        values = [f"Channel {ii+1}" for ii in range(num_channels)]
+        self.cmb_channel['values'] = values
+        if self._vars['plot_channel'].get() not in values:
+            self._vars['plot_channel'].set(values[0])
+
+
+    def selected_channel(self):
+        """ Index of the channel chosen in the selector. """
+        try:
+            return self.cmb_channel['values'].index(
+                self._vars['plot_channel'].get())
+        except ValueError:
+            return 0
+
+
+    def plot_spectra(self, channel, stim, noise):
+        """ Update the persistent plot with new spectra.
+
+            stim, noise: plotmodel.BinnedSpectrum objects (levels 
+                and min/max envelopes in dB on a log-frequency grid)
+        """
+        self.line_stim.set_data(stim.f, stim.level)
+        self.line_noise.set_data(noise.f, noise.level)
+
+        # Replace the min/max envelopes
+        for envelope in self.envelopes:
+            envelope.remove()
+        self.envelopes = [
+            self.ax.fill_between(spec.f, spec.lower, spec.upper, 
+                color=line.get_color(), alpha=0.2, linewidth=0)
+            for spec, line in ((stim, self.line_stim), 
+                (noise, self.line_noise))
+        ]
+
+        self.ax.set_title(f"Power Spectral Density for Channel {channel+1}")
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self.canvas.draw_idle()